@@ -1,5 +1,10 @@
 
 
+import os
+import hmac
+import json
+import time
+import threading
 import numpy as np
 import pandas as pd
 from datetime import date
@@ -8,17 +13,25 @@ import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output, ALL
+from dash.dependencies import Input, Output, State, ALL, ClientsideFunction
 import dash_table
 from dash_table.Format import Format, Scheme, Sign
 
 import plotly.graph_objects as go
-import plotly.express as px
 import plotly.io as pio
+from flask import jsonify, request, Response
 
 from layout_helpers import *
 from data_helpers import *
 from finance_helpers import *
+from calendar_helpers import *
+from cache_helpers import *
+from screener_helpers import run_screener
+from portfolio_helpers import Portfolio
+from history_helpers import (HISTORY_DIR, archive_day, backtest,
+                             history_lock, last_archived)
+from strategy_helpers import optimize_strategies
+from metrics_helpers import metrics, profiler, instrument_callback
 
 
 # Plotly settings
@@ -43,18 +56,184 @@ pio.templates["custom"] = go.layout.Template(
 pio.templates.default = 'custom'
 
 
-#
-selic = last_selic()
-feriados = list(cache_data('feriados.csv', download_feriados)['Data'])
-empresas = cache_data('ativos.csv', download_ativos)
-opcoes = cache_data('opcoes.csv', download_opcoes)
-opcoes = opcoes[pd.to_datetime(opcoes['vencimento']) > pd.to_datetime(date.today())]
-tickers_proxvenc = opcoes['base_ticker'][opcoes['vencimento'] ==
-                                         opcoes['vencimento'].min()].unique()
-empresas['base_ticker'] = empresas['ticker_acao'].str[:4]
-empresas = empresas[empresas['base_ticker'].isin(tickers_proxvenc)]
-empresas = empresas.sort_values('part', ascending=False).drop_duplicates('base_ticker')
-vencims = opcoes['vencimento'].sort_values().unique()
+# REFERENCE DATA
+# Loaded from the last cached snapshot at import, without touching the
+# network, so workers boot fast and gunicorn --preload shares the copy.
+# Missing or expired data is (re)loaded in the background.
+def build_reference(feriados, empresas, opcoes):
+    opcoes = opcoes[pd.to_datetime(opcoes['vencimento']) > pd.to_datetime(date.today())]
+    tickers_proxvenc = opcoes['base_ticker'][opcoes['vencimento'] ==
+                                             opcoes['vencimento'].min()].unique()
+    empresas = empresas.copy()
+    empresas['base_ticker'] = empresas['ticker_acao'].str[:4]
+    empresas = empresas[empresas['base_ticker'].isin(tickers_proxvenc)]
+    empresas = empresas.sort_values('part', ascending=False).drop_duplicates('base_ticker')
+    chains = ChainStore(opcoes)
+    return {'calendario': BusinessCalendar(feriados['Data']),
+            'empresas': empresas,
+            'chains': chains,
+            'vencims': np.array(chains.vencimentos())}
+
+
+def load_reference(refresh=True):
+    frames = [
+        cache_data('feriados.csv', download_feriados, ttl=365 * 86400,
+                   refresh=refresh),
+        cache_data('ativos.csv', download_ativos, ttl=30 * 86400,
+                   refresh=refresh),
+        cache_data('opcoes.csv', download_opcoes,
+                   ttl=float(os.environ.get('OPCOES_INTERVAL', 6 * 3600)),
+                   refresh=refresh),
+    ]
+    if any(df is None for df in frames):
+        return None
+    return build_reference(*frames)
+
+
+def load_selic(refresh=True):
+    df = cache_data('selic.csv',
+                    lambda: pd.DataFrame({'selic': [float(last_selic())]}),
+                    ttl=float(os.environ.get('SELIC_INTERVAL', 3600)),
+                    refresh=refresh)
+    return None if df is None else float(df['selic'].iloc[0])
+
+
+def reference():
+    ref = ensure_reference()
+    if ref is None:
+        raise dash.exceptions.PreventUpdate
+    return ref
+
+
+loaders = {}
+loaders_lock = threading.Lock()
+def ensure_loaded(name):
+    # While a source is missing, every request may start a load of it in the
+    # background, at most one at a time and once per LOAD_RETRY s
+    value = refresher.get(name)
+    if value is not None:
+        return value
+    with loaders_lock:
+        loader = loaders.setdefault(name, {'thread': None, 'at': 0.})
+        thread = loader['thread']
+        retry = float(os.environ.get('LOAD_RETRY', 60))
+        if (thread is None or not thread.is_alive()) and \
+                time.time() - loader['at'] >= retry:
+            loader['at'] = time.time()
+            loader['thread'] = threading.Thread(
+                target=refresher.refresh, args=(name,), daemon=True)
+            loader['thread'].start()
+    return None
+
+
+def ensure_reference():
+    return ensure_loaded('reference')
+
+
+def current_selic():
+    # Never fetched on the request path: until the first load lands,
+    # callbacks are skipped and routes answer 503
+    selic = ensure_loaded('selic')
+    if selic is None:
+        raise dash.exceptions.PreventUpdate
+    return float(selic)
+
+
+# BACKGROUND REFRESH
+def refresh_watchlist():
+    # Warm the quote cache for the underlyings and their nearest series
+    quotes = quote_service.get(watchlist, max_age=0)
+    chains = reference()['chains']
+    tickers = []
+    for ticker, spot in zip(quotes['ticker'], quotes['cotacao']):
+        for vencim in chains.vencimentos(ticker[:4])[:2]:
+            tickers += list(chains.nearest(ticker[:4], vencim, spot,
+                ['call', 'put', 'americano', 'europeu', 'ITM', 'OTM', 'ATM'],
+                20)['ticker'])
+    quote_service.get(tickers, max_age=0)
+    return quotes
+
+
+def screen_market():
+    ref = reference()
+    spots = get_quotes(ref['empresas']['ticker_acao'])
+    return run_screener(ref['chains'],
+                        dict(spots[['ticker', 'cotacao']].values),
+                        current_selic(), ref['calendario'], get_quotes,
+                        history_fn=os.path.join(CACHE_DIR, 'iv_history.csv'))
+
+
+def refresh_screener():
+    # Whichever worker holds the lock runs the screener when the published
+    # run is older than SCREENER_INTERVAL; the others read that run
+    ttl = float(os.environ.get('SCREENER_INTERVAL', 15 * 60))
+    with file_lock(os.path.join(CACHE_DIR, '.screener-run.lock'),
+                   blocking=False) as locked:
+        return cache_data('screener.csv', screen_market, ttl=ttl,
+                          refresh=locked)
+
+
+def archive_history():
+    # Polled by the refresher; archives the watchlist's chain quotes and
+    # closes once per business day after HISTORY_AT, in whichever worker
+    # gets there first
+    today = date.today()
+    ref = reference()
+    if time.strftime('%H:%M') < os.environ.get('HISTORY_AT', '18:30') or \
+            last_archived() == str(today) or \
+            not np.is_busday(today, busdaycal=ref['calendario'].busdaycal):
+        return last_archived()
+    with history_lock(HISTORY_DIR, 'daily', blocking=False) as locked:
+        if not locked or last_archived() == str(today):
+            return last_archived()
+        spots = quote_service.get(watchlist, max_age=0)[['ticker', 'cotacao']]
+        frames = [ref['chains'].underlying(t[:4]).assign(ativo=t)
+                  for t in spots['ticker']]
+        chain = pd.concat(frames, ignore_index=True)
+        chain = pd.merge(chain, get_quotes(chain['ticker'].values)[
+            ['ticker', 'cotacao']], on='ticker', how='left')
+        archive_day(today, chain, spots.rename(columns={'ticker': 'ativo'}))
+    return last_archived()
+
+
+watchlist = os.environ.get('WATCHLIST', 'BOVA11').split(',')
+refresher = Refresher()
+refresher.add('selic', load_selic,
+              float(os.environ.get('SELIC_INTERVAL', 3600)),
+              initial=load_selic(refresh=False))
+refresher.add('reference', load_reference,
+              float(os.environ.get('OPCOES_INTERVAL', 6 * 3600)),
+              initial=load_reference(refresh=False))
+refresher.add('watchlist', refresh_watchlist,
+              float(os.environ.get('WATCHLIST_INTERVAL', 10)))
+refresher.add('screener', refresh_screener,
+              float(os.environ.get('SCREENER_POLL', 60)), own_thread=True)
+refresher.add('history', archive_history,
+              float(os.environ.get('HISTORY_INTERVAL', 300)))
+
+
+def start_background():
+    # Threads do not survive a fork, so this runs in each worker on its
+    # first request rather than at import
+    ensure_reference()
+    ensure_loaded('selic')
+    if os.environ.get('BACKGROUND_REFRESH', '0') == '1':
+        refresher.start()
+
+
+# SERVER-SIDE RESULTS
+chain_results = ResultStore(
+    maxsize=int(os.environ.get('RESULT_STORE_SIZE', 256)),
+    path=os.environ.get('RESULT_STORE_DIR'),
+    max_age=float(os.environ.get('RESULT_STORE_MAX_AGE', 3600)),
+    max_files=int(os.environ.get('RESULT_STORE_MAX_FILES', 1024)))
+analytics_cache = LRUCache(int(os.environ.get('ANALYTICS_CACHE_SIZE', 512)))
+portfolios = LRUCache(int(os.environ.get('PORTFOLIO_CACHE_SIZE', 256)))
+scenario_cubes = LRUCache(int(os.environ.get('SCENARIO_CACHE_SIZE', 64)))
+metrics.register_cache('quotes', quote_service)
+metrics.register_cache('analytics', analytics_cache)
+metrics.register_cache('chain_results', chain_results.memory)
+metrics.register_cache('scenarios', scenario_cubes)
 
 # APP INITIALIZATION
 app = dash.Dash(
@@ -62,36 +241,59 @@ app = dash.Dash(
     external_stylesheets=[dbc.themes.BOOTSTRAP]
 )
 server = app.server
+server.before_first_request(start_background)
 
 
 # TABLE
+int_fmt = Format(precision=0, scheme=Scheme.fixed, sign=Sign.parantheses)
+numeric_fmt = Format(precision=2, scheme=Scheme.fixed, sign=Sign.parantheses)
 table = dash_table.DataTable(id='options_table', data=[], columns=[],
     style_as_list_view=True, style_header={'fontWeight': 'bold'})
 
 
 # SIDEBAR
-empresas_opt = [{'label': s, 'value': s} for s in empresas['ticker_acao']]
-vencims_opt = [{'label': s, 'value': s} for s in vencims]
 tipos = ['call', 'put', 'americano', 'europeu', 'ITM', 'OTM', 'ATM']
-sidebar = gen_grid([
-    [['Ativo',
-      dcc.Dropdown(id='empresa', value='BOVA11', clearable=False,
-                   options=empresas_opt, persistence=True)],
-     ['Vencimento', dcc.Dropdown(id='vencim', clearable=False,
-                                 value=vencims.min(), options=vencims_opt)],
-     ['Posição no ativo',
-      dcc.Input(id='posicao_ativo', type='number', value=0,
-                className='form-control')]],
-    [dbc.Checklist(id='tipos', value=tipos, inline=True, switch=True,
-        options=[{'label':s,'value':s} for s in tipos])],
-    [dbc.Spinner(table)]
-])
+def gen_sidebar(ref):
+    empresas = [] if ref is None else ref['empresas']['ticker_acao']
+    vencims = [] if ref is None else ref['vencims']
+    return gen_grid([
+        [['Ativo',
+          dcc.Dropdown(id='empresa', value='BOVA11', clearable=False,
+                       options=[{'label': s, 'value': s} for s in empresas],
+                       persistence=True)],
+         ['Vencimento', dcc.Dropdown(id='vencim', clearable=False,
+             value=min(vencims) if len(vencims) else None,
+             options=[{'label': s, 'value': s} for s in vencims])],
+         ['Posição no ativo',
+          dcc.Input(id='posicao_ativo', type='number', value=0,
+                    className='form-control')]],
+        [dbc.Checklist(id='tipos', value=tipos, inline=True, switch=True,
+            options=[{'label':s,'value':s} for s in tipos])],
+        [dbc.Spinner(table)]
+    ])
 # CARDS
-cards = html.Div([
-    gen_card('', id='quote_card', title='Cotação do ativo'),
-    gen_card(selic, id='selic_card', title='SELIC'),
-    gen_card('', id='dias_vencim', title='Dias para vencimento')
-], className='row')
+def gen_cards(selic):
+    return html.Div([
+        gen_card('', id='quote_card', title='Cotação do ativo'),
+        gen_card(selic, id='selic_card', title='SELIC'),
+        gen_card('', id='dias_vencim', title='Dias para vencimento')
+    ], className='row')
+
+
+# SCREENER
+screener_table = dash_table.DataTable(id='screener_table', data=[],
+    columns=[{'name': s.replace('_', ' '), 'id': s, 'type': 'text'}
+             for s in ['ativo', 'vencimento', 've_ticker']] +
+            [{'name': s.replace('_', ' '), 'id': s, 'type': 'numeric',
+              'format': numeric_fmt} for s in
+             ['dias', 'spot', 'series', 'atm_vol', 'iv_rank', 'skew', 've_pct']],
+    sort_action='native', filter_action='native', page_size=20,
+    style_as_list_view=True, style_header={'fontWeight': 'bold'})
+screener = html.Div([
+    html.H5('Screener'),
+    screener_table,
+    dcc.Interval(id='screener_interval', interval=60 * 1000)
+])
 
 
 # MAIN GRID
@@ -103,6 +305,70 @@ grid = gen_grid([
     [spinner_graph(id='payoff_plot'),
      spinner_graph(id='simulation_plot')]
 ])
+stores = [dcc.Store(id=s) for s in ['payoff_data', 'simulation_data']]
+PLOT_POINTS = int(os.environ.get('PLOT_POINTS', 400))
+
+
+# SCENARIOS
+vol_shifts = np.round(np.arange(-0.2, 0.201, 0.05), 2)
+spot_moves = np.round(np.arange(-0.2, 0.201, 0.01), 2)
+scenario_metrics = {'pnl': 'P&L', 'delta': 'Delta', 'gamma': 'Gama',
+                    'vega': 'Vega', 'theta': 'Theta'}
+scenarios = html.Div([
+    html.H5('Cenários'),
+    gen_grid([
+        [dbc.RadioItems(id='scenario_metric', value='pnl', inline=True,
+            options=[{'label': v, 'value': k}
+                     for k, v in scenario_metrics.items()])],
+        [['Choque de vol.',
+          dcc.Slider(id='vol_shift', min=vol_shifts[0], max=vol_shifts[-1],
+                     step=0.05, value=0,
+                     marks={float(v): f'{100 * v:.0f}%' for v in vol_shifts})],
+         ['Skew',
+          dcc.Slider(id='vol_skew', min=-0.5, max=0.5, step=0.25, value=0,
+                     marks={v: str(v) for v in [-0.5, -0.25, 0, 0.25, 0.5]})]],
+        [spinner_graph(id='scenario_plot')]
+    ])
+])
+
+
+# BACKTEST
+backtest_section = html.Div([
+    html.H5('Backtest'),
+    dbc.Button('Rodar backtest', id='backtest_button', color='secondary',
+               size='sm'),
+    spinner_graph(id='backtest_plot')
+])
+
+
+# STRATEGIES
+strategies_table = dash_table.DataTable(id='strategies_table', data=[],
+    columns=[{'name': s.replace('_', ' '), 'id': s, 'type': 'text'}
+             for s in ['estrategia', 'pernas']] +
+            [{'name': s.replace('_', ' '), 'id': s, 'type': 'numeric',
+              'format': numeric_fmt} for s in
+             ['premio', 'delta', 'max_gain', 'max_loss', 'ev', 'prob_profit']],
+    sort_action='native', page_size=10,
+    style_as_list_view=True, style_header={'fontWeight': 'bold'})
+strategies = html.Div([
+    html.H5('Estratégias'),
+    html.Small('Ordenadas por probabilidade de lucro. EV e probabilidade sob '
+               'a distribuição implícita no smile da série: sem uma visão '
+               'própria de drift ou volatilidade, estruturas a preço justo '
+               'têm EV nulo.', className='text-muted'),
+    gen_grid([
+        [['Perda máx. (R$)',
+          dcc.Input(id='strategy_max_loss', type='number', value=5,
+                    className='form-control')],
+         ['Delta',
+          dcc.RangeSlider(id='strategy_delta', min=-1, max=1, step=0.05,
+                          value=[-0.3, 0.3],
+                          marks={v: str(v) for v in [-1, -0.5, 0, 0.5, 1]})],
+         [dbc.Button('Buscar estratégias', id='strategy_button',
+                     color='secondary', size='sm')]],
+        [dbc.Spinner(strategies_table)]
+    ])
+])
 
 
 # LAYOUT
@@ -112,38 +378,52 @@ navbar = gen_navbar(app.title,
 hidden = html.Div(
     [html.Div([], id=s) for s in ['options_data']],
     style={'display': 'none'})
-app.layout = html.Div([
-    navbar,
-    html.Div([
-        cards,
-        sidebar,
-        grid,
-    ], className='container'),
-    html.Footer([
+def serve_layout():
+    # Built per page load so the dropdowns follow the latest reference data
+    ref = ensure_reference()
+    return html.Div([
+        navbar,
         html.Div([
-            'Este aplicativo tem objetivo exclusivamente educacional e ' + \
-            'todos os dados possuem caráter informativo. Não nos ' + \
-            'responsabilizamos pelas decisões e caminhos tomados tomados ' + \
-            'pelo usuário a partir da análise das informações aqui ' + \
-            'disponibilizadas.'
-        ], className='container')
-    ], className='footer text-muted'),
-    hidden
-])
+            gen_cards(refresher.get('selic', '')),
+            html.Div('Carregando dados de referência...',
+                     className='alert alert-info') if ref is None else '',
+            gen_sidebar(ref),
+            grid,
+            *stores,
+            scenarios,
+            backtest_section,
+            strategies,
+            screener,
+        ], className='container'),
+        html.Footer([
+            html.Div([
+                'Este aplicativo tem objetivo exclusivamente educacional e ' + \
+                'todos os dados possuem caráter informativo. Não nos ' + \
+                'responsabilizamos pelas decisões e caminhos tomados tomados ' + \
+                'pelo usuário a partir da análise das informações aqui ' + \
+                'disponibilizadas.'
+            ], className='container')
+        ], className='footer text-muted'),
+        hidden
+    ])
+app.layout = serve_layout
 
 
 # CALLBACKS
 @app.callback(
     Output('dias_vencim', 'children'),
     [Input('vencim', 'value')])
+@instrument_callback
 def update_wdays(vencim):
-    return np.busday_count(np.datetime64('today', 'D'), vencim,
-                           holidays=feriados)
+    if vencim is None:
+        raise dash.exceptions.PreventUpdate
+    return reference()['calendario'].days_to(vencim)
 
 
 @app.callback(
     Output('quote_card', 'children'),
     [Input('empresa', 'value')])
+@instrument_callback
 def update_quote(empresa):
     return get_quotes([empresa]).tail(1)['cotacao'].values
 
@@ -155,55 +435,66 @@ def update_quote(empresa):
      Input('tipos', 'value'),
      Input('quote_card', 'children'),
      Input('dias_vencim', 'children')])
+@instrument_callback
 def update_data(empresa, vencim, tipos, cotacao_ativo, dias_vencim):
-    df = opcoes[(opcoes['base_ticker'] == empresa[:4]) &
-                (opcoes['tipo_opcao'].isin(tipos)) &
-                (opcoes['tipo_exercicio'].str.lower().isin(tipos)) &
-                (opcoes['vencimento'] == vencim)]
-    cotacao_ativo = cotacao_ativo[0]
-    dias_vencim = int(dias_vencim)
-    df['diffstrike'] = np.abs(cotacao_ativo - df['strike'])
-    df.sort_values('diffstrike', inplace=True)
-    df['VI'] = np.where(df['tipo_opcao'] == 'call',
-                        cotacao_ativo - df['strike'],
-                        df['strike'] - cotacao_ativo)
-    df['VI'] = np.where(df['VI'] < 0, 0, df['VI'])
+    params = {'empresa': empresa, 'vencim': vencim, 'tipos': sorted(tipos),
+              'cotacao_ativo': float(cotacao_ativo[0]),
+              'dias_vencim': int(dias_vencim)}
+    df = compute_chain(**params)
+    # Only the key goes to the browser; the chain stays on the server
+    params['quotes'] = quote_service.stamp(df['ticker'])
+    key = json.dumps(params, sort_keys=True)
+    chain_results.put(key, df)
+    return [key]
+
+
+def compute_chain(empresa, vencim, tipos, cotacao_ativo, dias_vencim):
+    df = reference()['chains'].nearest(empresa[:4], vencim, cotacao_ativo, tipos, 20)
+
+    with metrics.stage('quotes', callback='update_data'):
+        quotes = get_quotes(df['ticker'].values)
+    df = pd.merge(df, quotes, on='ticker', how='left')
 
-    df['money'] = np.where(df['VI'] > 0, 'ITM', 'OTM')
-    df['money'] = np.where(df['diffstrike'] <= 0.5, 'ATM', df['money'])
-    df = df[df['money'].isin(tipos)]
+    # IV and greeks only change with the quotes, rate and time to expiry
+    selic = current_selic()
+    key = (empresa[:4], vencim, selic, dias_vencim, cotacao_ativo,
+           tuple(df['ticker']), quote_service.stamp(df['ticker']))
+    result = analytics_cache.get(key)
+    if result is None:
+        with metrics.stage('analytics', callback='update_data'):
+            result = chain_analytics(df, cotacao_ativo, selic, dias_vencim)
+        analytics_cache.put(key, result)
+
+    return result[['ticker', 'strike', 'tipo_opcao', 'tipo_exercicio', 'money',
+                   'cotacao', 'VI', 'VE', 'Vol', 'delta', 'gamma', 'vega', 'theta', 'rho']]
+
+
+def chain_result(key):
+    df = chain_results.get(key)
+    if df is None:
+        # Evicted, or computed by another worker without a shared store
+        params = json.loads(key)
+        params.pop('quotes')
+        df = compute_chain(**params)
+        chain_results.put(key, df)
+    return df
+
+@app.callback(
+    Output('screener_table', 'data'),
+    [Input('screener_interval', 'n_intervals')])
+@instrument_callback
+def update_screener(n_intervals):
+    df = refresher.get('screener')
+    return [] if df is None else df.to_dict('records')
 
-    df = df.head(20).rename(columns={'ticker_opcao':'ticker'})
 
-    quotes = get_quotes(df['ticker'].values)
-    df = pd.merge(df, quotes, on='ticker', how='left')
-    df['VE'] = df['cotacao'] - df['VI']
-
-    # Calculate implied volatility
-    df['Vol'] = df.apply(
-        lambda x: implied_vol(x['cotacao'], cotacao_ativo,
-        x['strike'], float(selic), dias_vencim, x['tipo_opcao']),
-        axis=1)
-    # Calculate greeks
-    gregas = black_scholes(cotacao_ativo, df['strike'], float(selic),
-            df['Vol'], dias_vencim, df['tipo_opcao'])[
-                ['delta','gamma','vega','theta','rho']
-            ]
-    df = pd.concat([df, gregas], axis=1)
-
-    df = df[['ticker', 'strike', 'tipo_opcao', 'tipo_exercicio', 'money',
-             'cotacao', 'VI', 'VE', 'Vol', 'delta', 'gamma', 'vega', 'theta', 'rho']]
-    return [df.to_json(date_format='iso', orient='split')]
-
-#
-int_fmt = Format(precision=0, scheme=Scheme.fixed, sign=Sign.parantheses)
-numeric_fmt = Format(precision=2, scheme=Scheme.fixed, sign=Sign.parantheses)
 @app.callback(
     [Output('options_table', 'data'),
      Output('options_table', 'columns')],
     [Input('options_data', 'children')])
+@instrument_callback
 def update_table(data):
-    df = pd.read_json(data[0], orient='split')
+    df = chain_result(data[0]).copy()
     df['posicao'] = 0
     return df.to_dict('records'), \
         [{'name': str(s).replace('_', ' '), 'id': str(s), 'type': 'numeric',
@@ -212,137 +503,295 @@ def update_table(data):
 
 
 @app.callback(
-    Output('payoff_plot', 'figure'),
+    Output('payoff_data', 'data'),
     [Input('options_table', 'data'),
-     Input('payoff_unit', 'value'),
      Input('quote_card', 'children'),
      Input('posicao_ativo', 'value'),
      Input('dias_vencim', 'children')]
 )
-def update_payoff(data, payoff_unit, cotacao_ativo, posicao_ativo, dias_vencim):
+@instrument_callback
+def update_payoff(data, cotacao_ativo, posicao_ativo, dias_vencim):
     if posicao_ativo is None or posicao_ativo == '':
         posicao_ativo = 0
     cotacao_ativo = cotacao_ativo[0]
-    df = pd.DataFrame(data)
-    cot_range = df['cotacao'].max()*2 + 1
-    strikes = np.arange(df['strike'].min()-cot_range, 
-                        df['strike'].max()+cot_range, 0.01)
-    medianvol = df['Vol'].median()
-    cotacao_bs = black_scholes(cotacao_ativo, df['strike'], float(selic),
-        medianvol, dias_vencim, df['tipo_opcao'])['price']
-    df['cotacao'] = np.where(df['cotacao'].isnull(), cotacao_bs, df['cotacao'])
-
-    df = df[(df['posicao'] != 0) & (df['posicao'] != "")]
-    custo = np.sum(df['posicao'] * df['cotacao']) + posicao_ativo*cotacao_ativo
-    if df.shape[0] == 0:
-        payoff = pd.DataFrame(
-            strikes * posicao_ativo - custo,
-            index=strikes, columns=['payoff'])
-    else:
-        payoff = pd.DataFrame(index=strikes, columns=df['ticker']).reset_index()
-        payoff = payoff.melt('index')
-        payoff = pd.merge(payoff, df, how='left')
-        payoff['Vol'] = payoff['Vol'].fillna(medianvol)
-        payoff['payoff'] = 0
-        payoff['payoff'] = np.where(payoff['tipo_opcao'] == 'call',
-                                    payoff['index'] - payoff['strike'],
-                                    payoff['payoff'])
-        payoff['payoff'] = np.where(payoff['tipo_opcao'] == 'put',
-                                    payoff['strike'] - payoff['index'],
-                                    payoff['payoff'])
-        payoff['payoff'] = np.where(payoff['payoff'] < 0, 0, payoff['payoff'])
-        payoff['payoff'] = payoff['payoff'] * payoff['posicao'].fillna(0)
-
-        payoff['tomorrow']  = black_scholes(payoff['index'], payoff['strike'],
-            float(selic), payoff['Vol'], dias_vencim - 1,
-            payoff['tipo_opcao'])['price']
-        payoff['tomorrow'] = payoff['tomorrow'] * payoff['posicao'].fillna(0)
-
-        payoff = payoff.groupby('index')[['payoff', 'tomorrow']].sum()
-        x = posicao_ativo * payoff.index - custo
-        payoff['payoff'] = payoff ['payoff'] + x
-        payoff['tomorrow'] = payoff ['tomorrow'] + x
-    payoff = payoff.rename(columns={'payoff':'vencimento', 'tomorrow':'amanhã'})
-    payoff = payoff.reset_index().melt('index')
-    if payoff_unit == '%':
-        payoff['value'] = 100 * (payoff['value'] / custo)
-        payoff['index'] = 100 * (payoff['index'] / cotacao_ativo - 1)
-        xlab = 'Variação'
-    else:
-        xlab = 'Cotação'
-    fig = px.line(payoff, x='index', y='value', color='variable',
-        title='Payoff no vencimento',
-        labels={'index':f'{xlab} do ativo ({payoff_unit})',
-                'value': f'Payoff ({payoff_unit})',
-                'variable':''})
-    if payoff_unit == 'R$':
-        fig.add_shape(type='line', line=dict(color='#999999', dash='dot'),
-            x0=cotacao_ativo, y0=payoff['value'].min()-1,
-            x1=cotacao_ativo, y1=payoff['value'].max()+1)
-    fig.update_traces(hovertemplate=None)
-    fig.update_layout(hovermode='x')
-    return fig
+    pf = portfolio_for(data, cotacao_ativo, posicao_ativo, dias_vencim)
+    cot_range = np.nanmax(pf.premium)*2 + 1
+    strikes = payoff_grid(np.append(pf.strike, cotacao_ativo),
+                          max(pf.strike.min() - cot_range, 0.01),
+                          pf.strike.max() + cot_range)
+
+    curves = pf.curves(strikes, [0, dias_vencim - 1])
+    stats = pf.stats()
+    series = [curves[0]]
+    if pf.active.any():
+        series.append(curves[dias_vencim - 1])
+    idx = minmax_indices(np.vstack(series), PLOT_POINTS)
+    # Figures are built client-side from these arrays (assets/figures.js)
+    return {
+        'x': to_list(strikes[idx]),
+        'expiry': to_list(series[0][idx]),
+        'tomorrow': to_list(series[1][idx]) if len(series) > 1 else None,
+        'breakevens': to_list(stats['breakevens']),
+        'max_gain': None if np.isinf(stats['max_gain']) else stats['max_gain'],
+        'max_loss': None if np.isinf(stats['max_loss']) else stats['max_loss'],
+        'cost': pf.cost,
+        'spot': cotacao_ativo,
+    }
+
+
+def portfolio_for(data, cotacao_ativo, posicao_ativo, dias_vencim):
+    # The chain part of the portfolio and its unit curves are shared across
+    # sessions and edits of the posicao column; each request gets its own
+    # view with the quantities from its table
+    selic = current_selic()
+    key = json.dumps([[(r['ticker'], r['cotacao'], r['Vol']) for r in data],
+                      cotacao_ativo, dias_vencim, selic])
+    pf = portfolios.get(key)
+    if pf is None:
+        pf = Portfolio.from_records(data, cotacao_ativo, 0, selic, dias_vencim)
+        portfolios.put(key, pf)
+    return pf.with_quantities(Portfolio.quantities(data), posicao_ativo)
 
 
 @app.callback(
-    Output('simulation_plot', 'figure'),
+    Output('simulation_data', 'data'),
     [Input('options_table', 'data'),
-     Input('payoff_unit', 'value'),
      Input('quote_card', 'children'),
      Input('posicao_ativo', 'value'),
      Input('dias_vencim', 'children'),
      Input('vencim', 'value')]
 )
-def update_montecarlo(data, payoff_unit, cotacao_ativo, posicao_ativo,
-                  dias_vencim, vencim):
+@instrument_callback
+def update_montecarlo(data, cotacao_ativo, posicao_ativo, dias_vencim, vencim):
     if posicao_ativo is None or posicao_ativo == '':
         posicao_ativo = 0
     cotacao_ativo = cotacao_ativo[0]
-    df = pd.DataFrame(data)
-    nsims = 100
-    vol = df['Vol'].max()
-    df['Vol'] = df['Vol'].fillna(df['Vol'].median())
-
-    cotacao_bs = black_scholes(cotacao_ativo, df['strike'], float(selic),
-        vol, dias_vencim, df['tipo_opcao'])['price']
-    df['cotacao'] = np.where(df['cotacao'].isnull(), cotacao_bs, df['cotacao'])
-    if '' in df['posicao'].values:
-        df['posicao'] = df['posicao'].replace('', 0).astype(float)
-    custo = np.sum(df['posicao'] * df['cotacao']) + posicao_ativo*cotacao_ativo
-
-    if (df['posicao'].min() == 0) and (df['posicao'].max() == 0) and \
-        (posicao_ativo == 0):
+    nsims = int(os.environ.get('NSIMS', 10000))
+    pf = portfolio_for(data, cotacao_ativo, posicao_ativo, dias_vencim)
+
+    # Nothing left to simulate on the expiry day (or a weekend before it)
+    if (not pf.active.any() and posicao_ativo == 0) or dias_vencim < 1:
+        return None
+
+    with metrics.stage('simulation', callback='update_montecarlo'):
+        sim = pf.simulate(npaths=nsims, antithetic=True)
+
+    datas = reference()['calendario'].date_axis(vencim, dias_vencim)
+    bands = sim['percentiles']
+    idx = minmax_indices(np.vstack(list(bands.values())), PLOT_POINTS)
+    return {
+        'x': [str(d) for d in np.asarray(datas)[idx]],
+        'paths': to_list(sim['paths'][idx].T),
+        'bands': {p: to_list(band[idx]) for p, band in bands.items()},
+        'mean': to_list(sim['mean'][idx]),
+        'prob': 100 * float(sim['prob_profit'][-1]),
+        'cost': pf.cost,
+    }
+
+
+for fig_id, data_id, fun in [('payoff_plot', 'payoff_data', 'payoff'),
+                             ('simulation_plot', 'simulation_data',
+                              'simulation')]:
+    app.clientside_callback(
+        ClientsideFunction(namespace='figures', function_name=fun),
+        Output(fig_id, 'figure'),
+        [Input(data_id, 'data'), Input('payoff_unit', 'value')])
+
+
+@app.callback(
+    Output('scenario_plot', 'figure'),
+    [Input('options_table', 'data'),
+     Input('quote_card', 'children'),
+     Input('posicao_ativo', 'value'),
+     Input('dias_vencim', 'children'),
+     Input('vol_skew', 'value'),
+     Input('vol_shift', 'value'),
+     Input('scenario_metric', 'value')]
+)
+@instrument_callback
+def update_scenarios(data, cotacao_ativo, posicao_ativo, dias_vencim,
+                     vol_skew, vol_shift, metric):
+    if posicao_ativo is None or posicao_ativo == '':
+        posicao_ativo = 0
+    cotacao_ativo = cotacao_ativo[0]
+    pf = portfolio_for(data, cotacao_ativo, posicao_ativo, dias_vencim)
+    if not pf.active.any() and posicao_ativo == 0:
         return {}
 
-    sim = pd.DataFrame(
-        np.random.normal(0, np.sqrt(vol**2 / 252), (dias_vencim, nsims)),
-        index=range(dias_vencim, 0, -1), columns=range(nsims)
-    ).cumsum().reset_index().melt('index', var_name='sim', value_name='logreturn')
-    sim['cotacao'] = cotacao_ativo * np.exp(sim['logreturn'])
-
-    sim['payoff'] = sim['cotacao'] * posicao_ativo - custo
-    for ticker in df['ticker'][df['posicao'] != 0]:
-        row = df[df['ticker'] == ticker]
-        v_op = black_scholes(sim['cotacao'], row['strike'].values[0],
-            float(selic), row['Vol'].values[0],
-            sim['index'], row['tipo_opcao'].values[0])
-        sim['payoff'] = sim['payoff'] + v_op['price'] * row['posicao'].values[0]
-
-    if payoff_unit == '%':
-        sim['payoff'] = 100 * sim['payoff'] / custo
-
-    sim['data'] = np.busday_offset(vencim, - sim['index'], 'backward',
-        holidays=feriados)
-
-    fig = px.line(sim, x='data', y='payoff', line_group='sim',
-        title='Simulações',
-        labels={'data': '', 'payoff': f'Payoff ({payoff_unit})'})
-    fig.update_traces(line={'color': 'rgba(153,153,153,0.5)'},
-        hovertemplate=None)
-    fig.update_layout(hovermode='closest')
+    # The whole cube is built once per portfolio and skew; moving the vol
+    # slider or switching metric only slices the cached arrays
+    dias = np.unique(np.linspace(0, dias_vencim, min(dias_vencim, 20) + 1)
+                     .round())[::-1]
+    key = (pf.signature(), vol_skew)
+    cube = scenario_cubes.get(key)
+    if cube is None:
+        with metrics.stage('scenarios', callback='update_scenarios'):
+            cube = pf.scenario_cube(spot_moves, dias, vol_shifts, vol_skew)
+        scenario_cubes.put(key, cube)
+    i = np.abs(vol_shifts - vol_shift).argmin()
+    z = cube[metric][:, :, i].T
+
+    with metrics.stage('figure', callback='update_scenarios'):
+        fig = go.Figure(go.Heatmap(
+            x=cotacao_ativo * (1 + spot_moves), y=dias, z=z,
+            colorscale='RdBu', zmid=0 if metric != 'gamma' else None,
+            colorbar={'title': scenario_metrics[metric]}))
+    fig.update_layout(
+        title=f'{scenario_metrics[metric]} por cotação e dias para vencimento '
+              f'(vol. {100 * vol_shifts[i]:+.0f}%)',
+        xaxis_title='Cotação do ativo (R$)', yaxis_title='Dias para vencimento')
+    return fig
 
+@app.callback(
+    Output('backtest_plot', 'figure'),
+    [Input('backtest_button', 'n_clicks')],
+    [State('options_table', 'data'),
+     State('posicao_ativo', 'value'),
+     State('empresa', 'value'),
+     State('vencim', 'value')]
+)
+@instrument_callback
+def update_backtest(n_clicks, data, posicao_ativo, empresa, vencim):
+    if not n_clicks:
+        raise dash.exceptions.PreventUpdate
+    if posicao_ativo is None or posicao_ativo == '':
+        posicao_ativo = 0
+    legs = pd.DataFrame(data, columns=['ticker', 'strike', 'tipo_opcao',
+                                       'Vol', 'posicao'])
+    legs['posicao'] = pd.to_numeric(legs['posicao'].replace('', 0)).fillna(0)
+    legs['vencimento'] = vencim
+    with metrics.stage('backtest', callback='update_backtest'):
+        res = backtest(legs, posicao_ativo, empresa, selic=current_selic(),
+                       calendar=reference()['calendario'])
+    if not len(res):
+        return {'layout': {'title': {'text': 'Sem histórico arquivado'}}}
+    fig = go.Figure(go.Scattergl(x=res.index, y=res['pnl'], mode='lines',
+                                 name='P&L'))
+    fig.update_layout(
+        title=f'P&L histórico ({res.index[0]:%d/%m/%Y} a '
+              f'{res.index[-1]:%d/%m/%Y})',
+        yaxis_title='P&L (R$)', hovermode='x')
     return fig
 
+@app.callback(
+    Output('strategies_table', 'data'),
+    [Input('strategy_button', 'n_clicks')],
+    [State('options_data', 'children'),
+     State('quote_card', 'children'),
+     State('dias_vencim', 'children'),
+     State('strategy_max_loss', 'value'),
+     State('strategy_delta', 'value')]
+)
+@instrument_callback
+def update_strategies(n_clicks, key, cotacao_ativo, dias_vencim, max_loss,
+                      delta_band):
+    if not n_clicks or not key:
+        raise dash.exceptions.PreventUpdate
+    with metrics.stage('strategies', callback='update_strategies'):
+        df, _ = optimize_strategies(
+            chain_result(key[0]), float(cotacao_ativo[0]), dias_vencim,
+            current_selic(), max_loss=max_loss, delta_band=delta_band,
+            npaths=int(os.environ.get('NSIMS', 10000)))
+    return df.replace([np.inf, -np.inf], np.nan).to_dict('records')
+
+# API
+def to_columns(df):
+    # Columnar JSON with NaN as null
+    return {c: [None if pd.isnull(v) else v for v in df[c].tolist()]
+            for c in df.columns}
+
+
+@server.route('/api/surface/<ticker>')
+def surface(ticker):
+    spot = get_quotes([ticker])['cotacao']
+    if spot.empty or pd.isnull(spot.iloc[0]):
+        return jsonify({'error': f'no quote for {ticker}'}), 404
+    spot = float(spot.iloc[0])
+    ref = ensure_reference()
+    if ref is None or ensure_loaded('selic') is None:
+        return jsonify({'error': 'reference data not loaded'}), 503
+    df = ref['chains'].underlying(ticker[:4])
+    df = pd.merge(df, get_quotes(df['ticker'].values)[['ticker', 'cotacao']],
+                  on='ticker', how='left')
+    dias = {v: ref['calendario'].days_to(v) for v in df['vencimento'].unique()}
+    df = vol_surface(df, spot, current_selic(),
+                     df['vencimento'].map(dias).values.astype(float))
+    df = df[df['dias'] > 0]
+    return jsonify({'ticker': ticker, 'spot': spot, 'selic': current_selic(),
+                    'columns': to_columns(df)})
+
+
+@server.route('/api/strategies/<ticker>')
+def strategies_endpoint(ticker):
+    # ?vencim=&max_loss=&max_premium=&delta_min=&delta_max=&drift=&top=
+    spot = get_quotes([ticker])['cotacao']
+    if spot.empty or pd.isnull(spot.iloc[0]):
+        return jsonify({'error': f'no quote for {ticker}'}), 404
+    spot = float(spot.iloc[0])
+    ref = ensure_reference()
+    if ref is None or ensure_loaded('selic') is None:
+        return jsonify({'error': 'reference data not loaded'}), 503
+    vencims = ref['chains'].vencimentos(ticker[:4])
+    vencim = request.args.get('vencim') or (vencims[0] if len(vencims) else None)
+    if vencim is None:
+        return jsonify({'error': f'no series for {ticker}'}), 404
+    dias = ref['calendario'].days_to(vencim)
+    chain = compute_chain(ticker, vencim, tipos, spot, dias)
+    arg = lambda k, default=None: request.args.get(k, default, type=float)
+    df, _ = optimize_strategies(chain, spot, dias, current_selic(),
+                                max_loss=arg('max_loss'),
+                                max_premium=arg('max_premium'),
+                                delta_band=(arg('delta_min', -np.inf),
+                                            arg('delta_max', np.inf)),
+                                drift=arg('drift'),
+                                top=request.args.get('top', 20, type=int))
+    return jsonify({'ticker': ticker, 'vencim': str(vencim), 'spot': spot,
+                    'columns': to_columns(df.replace([np.inf, -np.inf],
+                                                     np.nan))})
+
+
+# HEALTH
+@server.route('/health')
+def health():
+    ready = ensure_reference() is not None and \
+        ensure_loaded('selic') is not None
+    return jsonify({'ready': ready,
+                    'updated_at': {k: v.isoformat() for k, v in
+                                   refresher.updated_at().items()}}), \
+        200 if ready else 503
+
+
+# METRICS
+@server.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@server.route('/metrics/profile')
+def profile_endpoint():
+    # ?action=start|stop|reset toggles the sampler, otherwise dump collapsed
+    # stacks. Disabled unless PROFILE_TOKEN is set; the token goes in the
+    # X-Profile-Token header.
+    token = os.environ.get('PROFILE_TOKEN')
+    if not token:
+        return Response('not found\n', status=404, mimetype='text/plain')
+    if not hmac.compare_digest(request.headers.get('X-Profile-Token', ''),
+                               token):
+        return Response('forbidden\n', status=403, mimetype='text/plain')
+    action = request.args.get('action')
+    if action == 'start':
+        profiler.start()
+    elif action == 'stop':
+        profiler.stop()
+    elif action == 'reset':
+        profiler.reset()
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+
+if os.environ.get('PROFILE', '0') == '1':
+    profiler.start()
+
+
 # ----
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,112 @@
+// Builds the payoff and simulation figures from the compact arrays the
+// server stores, so switching R$/% never goes back to the server
+
+function scaleArray(values, f) {
+    return values.map(function(v) { return v === null ? null : f(v); });
+}
+
+function fmtExtremo(value, cost, unit) {
+    if (value === null) {
+        return 'ilimitado';
+    }
+    if (unit === '%') {
+        return (100 * value / cost).toFixed(1) + '%';
+    }
+    return 'R$ ' + value.toFixed(2);
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    figures: {
+        payoff: function(data, unit) {
+            if (!data) {
+                return {};
+            }
+            var pct = unit === '%';
+            var fx = function(v) { return pct ? 100 * (v / data.spot - 1) : v; };
+            var fy = function(v) { return pct ? 100 * v / data.cost : v; };
+            var x = scaleArray(data.x, fx);
+            var traces = [{
+                type: 'scattergl', mode: 'lines', name: 'vencimento',
+                x: x, y: scaleArray(data.expiry, fy)
+            }];
+            if (data.tomorrow) {
+                traces.push({
+                    type: 'scattergl', mode: 'lines', name: 'amanhã',
+                    x: x, y: scaleArray(data.tomorrow, fy)
+                });
+            }
+            if (data.breakevens.length > 0) {
+                traces.push({
+                    type: 'scattergl', mode: 'markers', name: 'breakeven',
+                    x: scaleArray(data.breakevens, fx),
+                    y: data.breakevens.map(function() { return 0; }),
+                    marker: {color: '#999999'}
+                });
+            }
+            var shapes = [];
+            if (!pct) {
+                shapes.push({
+                    type: 'line', xref: 'x', yref: 'paper',
+                    x0: data.spot, x1: data.spot, y0: 0, y1: 1,
+                    line: {color: '#999999', dash: 'dot'}
+                });
+            }
+            var xlab = pct ? 'Variação' : 'Cotação';
+            return {
+                data: traces,
+                layout: {
+                    title: {text: 'Payoff no vencimento (ganho máx.: ' +
+                        fmtExtremo(data.max_gain, data.cost, unit) +
+                        ', perda máx.: ' +
+                        fmtExtremo(data.max_loss, data.cost, unit) + ')'},
+                    xaxis: {title: {text: xlab + ' do ativo (' + unit + ')'}},
+                    yaxis: {title: {text: 'Payoff (' + unit + ')'}},
+                    legend: {title: {text: ''}},
+                    shapes: shapes,
+                    hovermode: 'x'
+                }
+            };
+        },
+
+        simulation: function(data, unit) {
+            if (!data) {
+                return {};
+            }
+            var scale = unit === '%' ? 100 / data.cost : 1;
+            var fy = function(v) { return v * scale; };
+            // All sample paths go in a single WebGL trace split by nulls
+            var px = [], py = [];
+            data.paths.forEach(function(path) {
+                px.push.apply(px, data.x);
+                py.push.apply(py, scaleArray(path, fy));
+                px.push(null);
+                py.push(null);
+            });
+            var traces = [{
+                type: 'scattergl', mode: 'lines', x: px, y: py,
+                line: {color: 'rgba(153,153,153,0.5)'},
+                hoverinfo: 'skip', showlegend: false
+            }];
+            Object.keys(data.bands).forEach(function(p) {
+                traces.push({
+                    type: 'scattergl', mode: 'lines', name: 'p' + p,
+                    x: data.x, y: scaleArray(data.bands[p], fy),
+                    line: {dash: p === '50' ? 'solid' : 'dot'}
+                });
+            });
+            traces.push({
+                type: 'scattergl', mode: 'lines', name: 'média',
+                x: data.x, y: scaleArray(data.mean, fy)
+            });
+            return {
+                data: traces,
+                layout: {
+                    title: {text: 'Simulações (prob. de lucro: ' +
+                        data.prob.toFixed(0) + '%)'},
+                    yaxis: {title: {text: 'Payoff (' + unit + ')'}},
+                    hovermode: 'closest'
+                }
+            };
+        }
+    }
+});
@@ -0,0 +1,200 @@
+# Offline benchmarks for the pricing helpers and the app callbacks.
+#
+#   python benchmark.py --strikes 40 --expiries 6 --positions 4 --save base.json
+#   python benchmark.py --compare base.json
+#
+# The network helpers in data_helpers are replaced by synthetic fixtures
+# before app is imported, so no request leaves the machine. App callbacks
+# are timed cold, with the app's caches cleared before every run, and warm
+# (suffix _warm), where they hit the memoized results.
+import shutil
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from plotly.utils import PlotlyJSONEncoder
+
+import data_helpers
+import finance_helpers as fh
+import history_helpers as hh
+
+SELIC = 13.65
+SPOT = 100.
+
+
+def synthetic_opcoes(strikes=20, expiries=4, underlyings=('BOVA',)):
+    vencims = pd.bdate_range(date.today(), periods=expiries * 21,
+                             freq='B')[20::21].strftime('%Y-%m-%d')
+    rows = []
+    for base in underlyings:
+        for i, v in enumerate(vencims):
+            for k in np.linspace(SPOT * 0.7, SPOT * 1.3, strikes):
+                for tipo, letra in [('call', 'A'), ('put', 'M')]:
+                    rows.append({'tipo_opcao': tipo,
+                                 'ticker_opcao': f'{base}{letra}{i}{k:.0f}',
+                                 'tipo_exercicio': 'EUROPEU',
+                                 'strike': round(k, 2), 'vencimento': v,
+                                 'base_ticker': base})
+    return pd.DataFrame(rows)
+
+
+def install_fixtures(opcoes):
+    feriados = pd.read_csv('feriados.csv')
+    ativos = pd.DataFrame({'ticker_acao': ['BOVA11'], 'empresa': ['BOVA'],
+                           'tipo': ['ETF'], 'qtde': ['0'], 'part': [100.]})
+    fixtures = {'opcoes.csv': opcoes, 'feriados.csv': feriados,
+                'ativos.csv': ativos,
+                'selic.csv': pd.DataFrame({'selic': [SELIC]})}
+    strikes = dict(zip(opcoes['ticker_opcao'], opcoes['strike']))
+    tipos = dict(zip(opcoes['ticker_opcao'], opcoes['tipo_opcao']))
+
+    def fetch_quotes(tickers, session=None, base_url=None):
+        tickers = list(tickers)
+        k = np.array([strikes.get(t, SPOT) for t in tickers])
+        tipo = np.array([tipos.get(t, 'call') for t in tickers])
+        price = fh.bs_price(SPOT, k, SELIC, 0.3, 30, tipo)
+        price = np.where(np.isin(tickers, list(strikes)), price, SPOT)
+        return pd.DataFrame({'ticker': tickers, 'data': str(date.today()),
+                             'cotacao': np.round(price, 2)})
+
+    data_helpers.cache_data = lambda fn, fun, **kwargs: fixtures[fn].copy()
+    data_helpers.last_selic = lambda: str(SELIC)
+    data_helpers.fetch_quotes = fetch_quotes
+
+
+def measure(fun, repeat, items=1, reset=None):
+    # reset, when given, runs untimed before every run
+    reset = reset or (lambda: None)
+    out = fun()
+    times = []
+    for _ in range(repeat):
+        reset()
+        t = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t)
+    reset()
+    tracemalloc.start()
+    fun()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = np.array(times) * 1000
+    return {'p50_ms': np.percentile(times, 50),
+            'p90_ms': np.percentile(times, 90),
+            'p99_ms': np.percentile(times, 99),
+            'throughput': items / (np.median(times) / 1000),
+            'peak_mb': peak / 2**20,
+            'payload_kb': payload_kb(out)}
+
+
+def payload_kb(out):
+    # Size of what Dash would serialize for a callback result
+    if isinstance(out, pd.DataFrame):
+        return 0.
+    return len(json.dumps(out, cls=PlotlyJSONEncoder)) / 2**10
+
+
+def run(args):
+    opcoes = synthetic_opcoes(args.strikes, args.expiries)
+    install_fixtures(opcoes)
+    import app
+    unwrap = lambda f: getattr(f, '__wrapped__', f)
+
+    n = len(opcoes)
+    rng = np.random.default_rng(0)
+    strike = opcoes['strike'].values
+    tipo = opcoes['tipo_opcao'].values
+    vol = rng.uniform(0.15, 0.6, n)
+    days = rng.integers(1, 252, n)
+    price = fh.bs_price(SPOT, strike, SELIC, vol, days, tipo)
+    grid = np.linspace(SPOT * 0.5, SPOT * 1.5, args.grid)
+
+    ref = app.reference()
+    vencim = ref['vencims'].min()
+    dias = ref['calendario'].days_to(vencim)
+    tipos = ['call', 'put', 'americano', 'europeu', 'ITM', 'OTM', 'ATM']
+    records = app.compute_chain('BOVA11', vencim, tipos, SPOT, dias).copy()
+    records['posicao'] = 0
+    records.loc[records.index[:args.positions], 'posicao'] = \
+        rng.choice([-1, 1], min(args.positions, len(records)))
+    records = records.to_dict('records')
+
+    history = tempfile.mkdtemp()
+    series = hh.generate_history(history, ('BOVA',), ndays=args.history_days)
+    legs = series[series['vencimento'] == series['vencimento'].max()] \
+        .iloc[:args.positions].assign(posicao=1)
+
+    def clear_caches():
+        for cache in [app.analytics_cache, app.portfolios, app.scenario_cubes,
+                      app.chain_results.memory, app.quote_service]:
+            cache.clear()
+
+    benches = {
+        'black_scholes': (lambda: fh.black_scholes(
+            SPOT, strike, SELIC, vol, days, tipo), n),
+        'bs_kernel_price': (lambda: fh.bs_kernel(
+            grid[:, None], strike[:args.strikes], 0.13, 0.1, 0.3, True),
+            grid.size * args.strikes),
+        'implied_vol_vec': (lambda: fh.implied_vol_vec(
+            price, SPOT, strike, SELIC, days, tipo), n),
+        'compute_chain': (lambda: app.compute_chain(
+            'BOVA11', vencim, tipos, SPOT, dias), 1, clear_caches),
+        'update_payoff': (lambda: unwrap(app.update_payoff)(
+            records, [SPOT], 0, dias), 1, clear_caches),
+        'update_montecarlo': (lambda: unwrap(app.update_montecarlo)(
+            records, [SPOT], 0, dias, vencim), 1, clear_caches),
+        'backtest': (lambda: hh.backtest(legs, 0, 'BOVA', selic=SELIC,
+                                         root=history), args.history_days),
+    }
+    results = {}
+    for name, (fun, items, *reset) in benches.items():
+        if args.only and name not in args.only:
+            continue
+        runs = {name: reset[0] if reset else None}
+        if reset:
+            runs[f'{name}_warm'] = None
+        for run_name, reset_fun in runs.items():
+            results[run_name] = measure(fun, args.repeat, items, reset_fun)
+            print(f'{run_name:20s} ' + '  '.join(
+                f'{k}={v:.4g}' for k, v in results[run_name].items()))
+    shutil.rmtree(history, ignore_errors=True)
+    return {'params': vars(args), 'results': results}
+
+
+def compare(current, baseline):
+    print('\nvs baseline (p50):')
+    for name, res in current['results'].items():
+        base = baseline['results'].get(name)
+        if base:
+            ratio = res['p50_ms'] / base['p50_ms']
+            print(f'{name:20s} {base["p50_ms"]:10.3f}ms -> ' +
+                  f'{res["p50_ms"]:10.3f}ms  ({ratio:.2f}x)')
+            if res.get('payload_kb') and base.get('payload_kb'):
+                print(f'{"":20s} {base["payload_kb"]:10.1f}kB -> ' +
+                      f'{res["payload_kb"]:10.1f}kB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--strikes', type=int, default=20)
+    parser.add_argument('--expiries', type=int, default=4)
+    parser.add_argument('--positions', type=int, default=4)
+    parser.add_argument('--grid', type=int, default=10000)
+    parser.add_argument('--history-days', type=int, default=252)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', nargs='*')
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    current = run(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(current, json.load(f))
@@ -0,0 +1,119 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class DiskStore:
+    # Pickled values under a directory every worker can reach. Files idle
+    # for more than max_age seconds, or beyond the max_files most recently
+    # used, are pruned from put() at most once every prune_interval seconds.
+    def __init__(self, path, max_age=3600, max_files=1024, prune_interval=60):
+        self.path = path
+        self.max_age = max_age
+        self.max_files = max_files
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.
+        os.makedirs(path, exist_ok=True)
+
+    def _fn(self, key):
+        return os.path.join(self.path,
+                            hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+    def get(self, key, default=None):
+        fn = self._fn(key)
+        try:
+            with open(fn, 'rb') as f:
+                value = pickle.load(f)
+            # mtime doubles as last use for pruning
+            os.utime(fn)
+            return value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+    def put(self, key, value):
+        fn = self._fn(key)
+        tmp = f'{fn}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fn)
+        if time.time() - self._pruned_at >= self.prune_interval:
+            self.prune()
+
+    def prune(self):
+        # Other workers may prune the same files concurrently
+        self._pruned_at = now = time.time()
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if now - mtime > self.max_age:
+                self._remove(entry.path)
+            elif entry.name.endswith('.pkl'):
+                files.append((mtime, entry.path))
+        files.sort(reverse=True)
+        for _, fn in files[self.max_files:]:
+            self._remove(fn)
+
+    def _remove(self, fn):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+
+class ResultStore:
+    # In-process LRU in front of an optional DiskStore shared by workers
+    def __init__(self, maxsize=256, path=None, **disk):
+        self.memory = LRUCache(maxsize)
+        self.disk = DiskStore(path, **disk) if path else None
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return default if value is None else value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
@@ -0,0 +1,39 @@
+from datetime import date
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+class BusinessCalendar:
+    # Holidays are parsed once into a numpy busdaycalendar; day counts and
+    # date axes per expiry are memoized since every callback asks for them
+    def __init__(self, holidays):
+        self.holidays = pd.to_datetime(pd.Series(list(holidays))) \
+            .values.astype('datetime64[D]')
+        self.busdaycal = np.busdaycalendar(holidays=self.holidays)
+        self._days_to = lru_cache(maxsize=256)(self._count_days_to)
+        self._date_axis = lru_cache(maxsize=64)(self._build_date_axis)
+
+    def count(self, start, end):
+        return np.busday_count(start, end, busdaycal=self.busdaycal)
+
+    def offset(self, dates, offsets, roll='backward'):
+        return np.busday_offset(dates, offsets, roll, busdaycal=self.busdaycal)
+
+    def days_to(self, vencim, today=None):
+        today = date.today() if today is None else today
+        return self._days_to(str(today), str(vencim))
+
+    def date_axis(self, vencim, days):
+        # Dates with days, days-1, ..., 1 business days left until vencim
+        return self._date_axis(str(vencim), int(days))
+
+    def _count_days_to(self, today, vencim):
+        return int(self.count(np.datetime64(today, 'D'),
+                              np.datetime64(vencim, 'D')))
+
+    def _build_date_axis(self, vencim, days):
+        axis = self.offset(np.datetime64(vencim, 'D'), -np.arange(days, 0, -1))
+        axis.flags.writeable = False
+        return axis
@@ -1,23 +1,34 @@
 
 
 import os
+import csv
+import fcntl
+import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from zipfile import ZipFile
-import urllib.request as ur
 from io import BytesIO
 import datetime
 import json
+from collections import namedtuple
+from contextlib import contextmanager
 
 import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 import xml.etree.ElementTree as ET
 
+from metrics_helpers import metrics
+
 
 def download_ativos(indice='IBRA'):
     url = 'http://bvmf.bmfbovespa.com.br/indices/ResumoCarteiraTeorica.aspx?' + \
         f'Indice={indice}'
     print(url)
+    metrics.inc('outbound_requests_total', 2, source='ativos')
     acoes = pd.read_html(url)[0]
     acoes.columns = ['ticker_acao', 'empresa', 'tipo', 'qtde', 'part']
     acoes['part'] = acoes['part'] / 1000
@@ -44,68 +55,523 @@ def download_opcoes():
         'market-data/consultas/mercado-a-vista/opcoes/series-autorizadas/'
     # url = 'http://www.bmfbovespa.com.br/pt_br/servicos/market-data/' + \
     #     'consultas/mercado-a-vista/opcoes/series-autorizadas/'
-    page = s.get(url0)
+    with metrics.stage('http', source='opcoes'):
+        page = s.get(url0)
     soup = BeautifulSoup(page.text, 'html.parser')
     url = soup.find("a", string="Lista Completa de Séries Autorizadas").get('href')
     url = 'http://www.b3.com.br' + url
     # url = 'http://www.bmfbovespa.com.br/' + url
     print(url)
 
-    # Unzip
-    filehandle, _ = ur.urlretrieve(url)
-    with ZipFile(filehandle, 'r') as zip_ref:
-        zip_ref.extractall()
-
-    if not os.path.exists('SI_D_SEDE.txt'):
-        raise Exception('SI_D_SEDE.txt not found')
-    else:
-        # Wrangle data
-        df = pd.read_csv('SI_D_SEDE.txt', '|', skiprows=1, header=None,
-                        names=['x1', 'empresa', 'x2', 'tipo_opcao', 'x3', 'x4',
-                                'ticker_empresa', 'tipo_acao', 'x5', 'x6', 'x7',
-                                'x8', 'x9', 'ticker_opcao', 'x10',
-                                'tipo_exercicio', 'strike', 'vencimento', 'x11'],
-                        usecols=[3, 13, 15, 16, 17],
-                        parse_dates=['vencimento'], infer_datetime_format=True)
-        df['base_ticker'] = df['ticker_opcao'].str[:4]
-        df['tipo_opcao'] = df['tipo_opcao'].replace({'OPCOES VENDA': 'put',
-                                                    'OPCOES COMPRA': 'call'})
-        df = df[df['tipo_opcao'].isin(['call', 'put'])]
-        df['ticker_opcao'] = df['ticker_opcao'].str.strip()
-        df['vencimento'] = pd.to_datetime(df['vencimento']).dt.strftime('%Y-%m-%d')
-        return df
+    metrics.inc('outbound_requests_total', 2, source='opcoes')
+    with metrics.stage('http', source='opcoes'):
+        content = s.get(url).content
+    return parse_series_zip(BytesIO(content))
+
+
+def parse_series_zip(fileobj, member='SI_D_SEDE.txt', max_logged=5):
+    # Streams the series file out of the zip through the C csv reader,
+    # keeping only the columns the app uses. Lines with too few fields, a
+    # bad strike or a bad expiry are skipped.
+    start = time.time()
+    tipos = {'OPCOES VENDA': 'put', 'OPCOES COMPRA': 'call'}
+    with ZipFile(fileobj) as zf:
+        if member not in zf.namelist():
+            raise Exception(f'{member} not found')
+        with zf.open(member) as raw:
+            # Repeated fields are read as categoricals, so the coercions
+            # below run once per distinct value
+            try:
+                raw = pd.read_csv(raw, sep='|', header=None, skiprows=1,
+                                  usecols=[3, 13, 15, 16, 17],
+                                  dtype={3: 'category', 13: object,
+                                         15: 'category', 16: 'category',
+                                         17: 'category'},
+                                  encoding='latin-1', quoting=csv.QUOTE_NONE,
+                                  skip_blank_lines=False)
+            except pd.errors.EmptyDataError:
+                raw = pd.DataFrame({c: pd.Categorical([]) for c in
+                                    [3, 13, 15, 16, 17]})
+    raw.columns = ['tipo', 'ticker_opcao', 'tipo_exercicio', 'strike',
+                   'vencimento']
+    rows = len(raw)
+
+    # Short lines come out with the trailing fields missing
+    cat = raw['strike'].cat
+    strike = np.append(pd.to_numeric(
+        pd.Series(cat.categories.astype(str)).str.strip()
+        .str.replace(',', '.'), errors='coerce').values, np.nan)[cat.codes]
+    short = raw['vencimento'].cat.codes.values == -1
+    bad_line = short | np.isnan(strike)
+    for i in np.flatnonzero(bad_line)[:max_logged]:
+        reason = 'too few fields' if short[i] \
+            else f'bad strike {raw["strike"].iat[i]!r}'
+        print(f'{member}:{i + 2}: skipping malformed line ({reason})')
+    bad = int(bad_line.sum())
+
+    cat = raw['tipo'].cat
+    tipo = np.append(cat.categories.map(tipos).values, None)[cat.codes]
+    keep = ~bad_line & pd.notnull(tipo)
+    raw, tipo, strike = raw[keep], tipo[keep], strike[keep]
+    # Each distinct expiry string is parsed once
+    vencimento = raw['vencimento'].cat.remove_unused_categories()
+    datas = pd.to_datetime(pd.Series(vencimento.cat.categories.astype(str))
+                           .str.strip(), format='%Y%m%d',
+                           errors='coerce').values
+    tickers = [t.strip() for t in raw['ticker_opcao'].fillna('')]
+    df = pd.DataFrame({
+        'tipo_opcao': pd.Categorical(tipo, categories=['call', 'put']),
+        'ticker_opcao': tickers,
+        'tipo_exercicio': raw['tipo_exercicio'].cat
+                          .remove_unused_categories().values,
+        'strike': strike.astype(np.float64),
+        'vencimento': datas[vencimento.cat.codes.values],
+        'base_ticker': pd.Categorical([t[:4] for t in tickers]),
+    })
+    invalid = df['vencimento'].isnull().values
+    if invalid.any():
+        for v in vencimento.cat.categories[pd.isnull(datas)][:max_logged]:
+            print(f'{member}: skipping series with bad expiry {v!r}')
+        bad += int(invalid.sum())
+        df = df[~invalid].reset_index(drop=True)
+
+    elapsed = time.time() - start
+    print(f'parsed {len(df)} series from {member} in {elapsed:.2f}s ' +
+          f'({rows / max(elapsed, 1e-9):.0f} rows/s, {bad} malformed)')
+    return df
 
 
 def last_selic():    
     data = datetime.datetime.now().strftime("%d/%m/%Y")
     url = f'https://www.bcb.gov.br/api/servico/sitebcb/bcdatasgs?serie=432&dataInicial={data}&dataFinal={data}'
-    return json.loads(requests.get(url).text)['conteudo'][0]['valor']
+    metrics.inc('outbound_requests_total', source='selic')
+    with metrics.stage('http', source='selic'):
+        return json.loads(requests.get(url).text)['conteudo'][0]['valor']
 
 
 def download_feriados():
+    metrics.inc('outbound_requests_total', source='feriados')
     return pd.read_excel(
         'https://www.anbima.com.br/feriados/arqs/feriados_nacionais.xls',
         skipfooter=9)[['Data']]
 
 
-def get_quotes(tickers):
-    url = 'http://bvmf.bmfbovespa.com.br/cotacoes2000/' + \
-        'FormConsultaCotacoes.asp?strListaCodigos=' + '|'.join(tickers)
-    page = requests.get(url)
+QUOTES_URL = os.environ.get(
+    'QUOTES_URL',
+    'http://bvmf.bmfbovespa.com.br/cotacoes2000/FormConsultaCotacoes.asp')
+
+
+def fetch_quotes(tickers, session=None, base_url=QUOTES_URL):
+    url = f'{base_url}?strListaCodigos=' + '|'.join(tickers)
+    metrics.inc('outbound_requests_total', source='quotes')
+    with metrics.stage('http', source='quotes'):
+        page = (session or requests).get(url, timeout=10)
     xml = ET.fromstring(page.text)
-    df = pd.DataFrame([p.attrib for p in xml.findall('Papel')])
-    df = df[['Codigo', 'Data', 'Ultimo']]
+    df = pd.DataFrame([p.attrib for p in xml.findall('Papel')],
+                      columns=['Codigo', 'Data', 'Ultimo'])
     df.columns = ['ticker', 'data', 'cotacao']
     df['cotacao'] = pd.to_numeric(df['cotacao'].str.replace(',','.'))
     return df
 
 
-def cache_data(fn, fun):
-    if os.path.exists(fn):
-        print(f'{fn} exists, using cached version')
-        return pd.read_csv(fn)
-    else:
-        print(f'{fn} does not exist, creating file')
+class QuoteService:
+    # Quotes cached per ticker for `ttl` seconds. Concurrent callers asking
+    # for the same tickers wait on the request already in flight instead of
+    # issuing their own, and misses are fetched in batches of `batch_size`,
+    # up to `max_workers` batches at a time, from `base_url`.
+    def __init__(self, ttl=15, batch_size=50, session=None, max_workers=4,
+                 base_url=QUOTES_URL):
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.base_url = base_url
+        self._pool = ThreadPoolExecutor(max_workers)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._cache = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tickers, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        tickers = list(dict.fromkeys(tickers))
+        now = time.time()
+        fetch, wait = [], []
+        with self._lock:
+            for t in tickers:
+                entry = self._cache.get(t)
+                if entry is not None and now - entry[0] <= max_age:
+                    self.hits += 1
+                    continue
+                self.misses += 1
+                if t in self._inflight:
+                    wait.append(self._inflight[t])
+                else:
+                    self._inflight[t] = threading.Event()
+                    fetch.append(t)
+
+        try:
+            batches = [fetch[i:i + self.batch_size]
+                       for i in range(0, len(fetch), self.batch_size)]
+            if len(batches) == 1:
+                self._fetch_batch(batches[0])
+            else:
+                list(self._pool.map(self._fetch_batch, batches))
+        finally:
+            with self._lock:
+                for t in fetch:
+                    self._inflight.pop(t).set()
+        for event in wait:
+            event.wait(30)
+        return self._frame(tickers)
+
+    def _fetch_batch(self, batch):
+        df = fetch_quotes(batch, self.session, self.base_url)
+        stamp = time.time()
+        with self._lock:
+            # Tickers missing from the response are cached as misses
+            for t in batch:
+                self._cache[t] = (stamp, None, np.nan)
+            for row in df.itertuples(index=False):
+                self._cache[row.ticker] = (stamp, row.data, row.cotacao)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache)}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stamp(self, tickers):
+        # Time of the oldest fetch among cached tickers, used as a version
+        with self._lock:
+            stamps = [self._cache[t][0] for t in tickers if t in self._cache]
+        return min(stamps) if stamps else None
+
+    def _frame(self, tickers):
+        with self._lock:
+            rows = [(t,) + self._cache[t][1:] for t in tickers
+                    if t in self._cache and self._cache[t][1] is not None]
+        return pd.DataFrame(rows, columns=['ticker', 'data', 'cotacao'])
+
+
+quote_service = QuoteService(ttl=float(os.environ.get('QUOTE_TTL', 15)))
+
+
+def get_quotes(tickers):
+    return quote_service.get(tickers)
+
+
+CACHE_DIR = os.environ.get('CACHE_DIR', 'cache')
+
+
+def write_columnar(df, path):
+    # One .npy file per column; strings are stored as int32 codes into a
+    # list of categories kept in meta.json
+    os.makedirs(path)
+    columns = []
+    for i, (name, col) in enumerate(df.items()):
+        fn = f'{i}.npy'
+        if pd.api.types.is_numeric_dtype(col) or \
+                pd.api.types.is_datetime64_dtype(col):
+            np.save(os.path.join(path, fn), col.values)
+            columns.append({'name': name, 'file': fn, 'kind': 'array'})
+        else:
+            cat = pd.Categorical(col)
+            np.save(os.path.join(path, fn), cat.codes.astype(np.int32))
+            columns.append({'name': name, 'file': fn,
+                            'kind': 'category'
+                                    if isinstance(col.dtype, pd.CategoricalDtype)
+                                    else 'object',
+                            'categories': [str(c) for c in cat.categories]})
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'columns': columns}, f)
+
+
+def read_columnar(path, mmap=True, where=None):
+    # Columns are memory-mapped by default. pandas copies them into its own
+    # blocks, so `where`, a function from the mapped columns (strings as
+    # categoricals over the stored codes) to a boolean mask, runs first and
+    # only the rows it keeps leave the page cache that processes share.
+    with open(os.path.join(path, 'meta.json')) as f:
+        columns = json.load(f)['columns']
+    data = {}
+    for col in columns:
+        values = np.load(os.path.join(path, col['file']),
+                         mmap_mode='r' if mmap else None)
+        if col['kind'] != 'array':
+            values = pd.Categorical.from_codes(values, col['categories'])
+        data[col['name']] = values
+    rows = None if where is None else np.flatnonzero(where(data))
+    frame = {}
+    for col in columns:
+        values = data[col['name']]
+        if rows is not None:
+            values = values[rows]
+        frame[col['name']] = np.asarray(values, dtype=object) \
+            if col['kind'] == 'object' else values
+    return pd.DataFrame(frame, columns=[col['name'] for col in columns])
+
+
+def _read_cache_meta(name):
+    fn = os.path.join(CACHE_DIR, f'{name}.json')
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_snapshot(meta):
+    # A snapshot removed or half-written by another process is a cache miss.
+    # Snapshots are small and read whole, so they are loaded without mmap.
+    try:
+        return read_columnar(os.path.join(CACHE_DIR, meta['snapshot']),
+                             mmap=False)
+    except (OSError, ValueError, KeyError) as e:
+        print(f'snapshot {meta.get("snapshot")} unreadable ({e!r})')
+        return None
+
+
+def _snapshot_stamp(name, snapshot):
+    return snapshot[len(name) + 1:].split('-')[0]
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    # Cross-process lock on a lock file; yields False when non-blocking and
+    # another process holds it
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _cache_lock(name):
+    # Serializes publish and cleanup across worker processes
+    return file_lock(os.path.join(CACHE_DIR, f'.{name}.lock'))
+
+
+def _publish_cache(name, df, source, fetched_at=None):
+    # Write a new snapshot directory and atomically repoint the sidecar to it
+    fetched_at = fetched_at or datetime.datetime.now()
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    snapshot = f'{name}-{fetched_at.strftime("%Y%m%d%H%M%S%f")}-{os.getpid()}'
+    write_columnar(df, os.path.join(CACHE_DIR, snapshot))
+    meta = {'source': source, 'fetched_at': fetched_at.isoformat(),
+            'snapshot': snapshot, 'rows': len(df)}
+    with _cache_lock(name):
+        current = _read_cache_meta(name)
+        if current is not None and os.path.exists(
+                os.path.join(CACHE_DIR, current.get('snapshot', ''))) and \
+                current['fetched_at'] > meta['fetched_at']:
+            # A peer published something newer while we were downloading
+            shutil.rmtree(os.path.join(CACHE_DIR, snapshot), ignore_errors=True)
+            return current
+        tmp = os.path.join(CACHE_DIR, f'.{name}.json.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(CACHE_DIR, f'{name}.json'))
+        # Only snapshots older than the one just replaced can go: a peer may
+        # still be reading that one, and newer ones may be about to publish.
+        if current is not None and 'snapshot' in current:
+            cutoff = _snapshot_stamp(name, current['snapshot'])
+            for d in os.listdir(CACHE_DIR):
+                if d.startswith(f'{name}-') and \
+                        _snapshot_stamp(name, d) < cutoff:
+                    shutil.rmtree(os.path.join(CACHE_DIR, d),
+                                  ignore_errors=True)
+    return meta
+
+
+def cache_data(fn, fun, ttl=None, refresh=True):
+    # With refresh=False the network is never touched: any snapshot is
+    # returned regardless of age, or None when there is none yet
+    name = os.path.splitext(os.path.basename(fn))[0]
+    meta = _read_cache_meta(name)
+    if meta is None and os.path.exists(fn):
+        print(f'importing {fn} into the columnar cache')
+        meta = _publish_cache(name, pd.read_csv(fn), fn,
+            datetime.datetime.fromtimestamp(os.path.getmtime(fn)))
+
+    if meta is not None:
+        age = datetime.datetime.now() - \
+            datetime.datetime.fromisoformat(meta['fetched_at'])
+        if not refresh or ttl is None or age.total_seconds() <= ttl:
+            cached = _read_snapshot(meta)
+            if cached is not None:
+                print(f'{name} cached at {meta["fetched_at"]}, using cached version')
+                return cached
+    if not refresh:
+        return None
+
+    print(f'{name} missing or expired, downloading')
+    try:
         df = fun()
-        df.to_csv(fn, index=False)
-        return df
+    except Exception as e:
+        stale = None if meta is None else _read_snapshot(meta)
+        if stale is None:
+            raise
+        print(f'download of {name} failed ({e!r}), using stale snapshot')
+        return stale
+    _publish_cache(name, df, getattr(fun, '__name__', str(fun)))
+    return df
+
+
+class ChainStore:
+    # Option series grouped by (base_ticker, vencimento), sorted by strike
+    # so each chain is a contiguous slice of the arrays below
+    def __init__(self, opcoes):
+        df = opcoes.copy()
+        df['vencimento'] = pd.to_datetime(df['vencimento']).dt.strftime('%Y-%m-%d')
+        df = df.sort_values(['base_ticker', 'vencimento', 'strike'],
+                            kind='mergesort').reset_index(drop=True)
+        self.ticker = df['ticker_opcao'].values
+        self.strike = df['strike'].values.astype(float)
+        self.vencimento = df['vencimento'].values
+        self.is_call = (df['tipo_opcao'] == 'call').values
+        self.tipo_exercicio = pd.Categorical(df['tipo_exercicio'])
+        self.exercicio_lower = np.array(
+            [str(s).lower() for s in self.tipo_exercicio.categories])
+        self.index = {
+            key: slice(idx[0], idx[-1] + 1) for key, idx in
+            df.groupby(['base_ticker', 'vencimento'], sort=False,
+                       observed=True).indices.items()
+        }
+
+    def vencimentos(self, base_ticker=None):
+        return sorted({v for b, v in self.index
+                       if base_ticker is None or b == base_ticker})
+
+    def chain(self, base_ticker, vencimento):
+        sl = self.index.get((base_ticker, vencimento), slice(0, 0))
+        return pd.DataFrame({
+            'ticker': self.ticker[sl],
+            'strike': self.strike[sl],
+            'tipo_opcao': np.where(self.is_call[sl], 'call', 'put'),
+            'tipo_exercicio': np.asarray(self.tipo_exercicio[sl]),
+        })
+
+    def underlying(self, base_ticker):
+        # Every expiry of an underlying, which are adjacent in the arrays
+        slices = [sl for (b, _), sl in self.index.items() if b == base_ticker]
+        sl = slice(min(s.start for s in slices), max(s.stop for s in slices)) \
+            if slices else slice(0, 0)
+        return pd.DataFrame({
+            'ticker': self.ticker[sl],
+            'vencimento': self.vencimento[sl],
+            'strike': self.strike[sl],
+            'tipo_opcao': np.where(self.is_call[sl], 'call', 'put'),
+            'tipo_exercicio': np.asarray(self.tipo_exercicio[sl]),
+        })
+
+    def nearest(self, base_ticker, vencimento, spot, tipos, n=20):
+        sl = self.index.get((base_ticker, vencimento), slice(0, 0))
+        strike = self.strike[sl]
+        is_call = self.is_call[sl]
+
+        mask = np.where(is_call, 'call' in tipos, 'put' in tipos)
+        mask &= np.isin(self.exercicio_lower, tipos)[
+            self.tipo_exercicio.codes[sl]]
+        diffstrike = np.abs(spot - strike)
+        vi = np.maximum(np.where(is_call, spot - strike, strike - spot), 0)
+        money = np.where(diffstrike <= 0.5, 'ATM',
+                         np.where(vi > 0, 'ITM', 'OTM'))
+        mask &= np.isin(money, tipos)
+
+        # Strikes are sorted, so the n nearest ones lie within n positions
+        # of the spot on either side
+        pos = np.flatnonzero(mask)
+        c = np.searchsorted(strike[pos], spot)
+        window = pos[max(c - n, 0):c + n]
+        sel = window[np.argsort(diffstrike[window], kind='mergesort')[:n]]
+
+        return pd.DataFrame({
+            'ticker': self.ticker[sl][sel],
+            'strike': strike[sel],
+            'tipo_opcao': np.where(is_call[sel], 'call', 'put'),
+            'tipo_exercicio': np.asarray(self.tipo_exercicio[sl])[sel],
+            'money': money[sel],
+            'diffstrike': diffstrike[sel],
+            'VI': vi[sel],
+        })
+
+
+Snapshot = namedtuple('Snapshot', ['value', 'updated_at'])
+
+
+class Refresher:
+    # Reruns each registered source on its own interval in a daemon thread.
+    # Slow sources can get a thread of their own so they do not hold up the
+    # others. Results are published by swapping in a new dict of Snapshots,
+    # so readers never block and never see a half-updated value. Published
+    # values must be treated as read-only.
+    def __init__(self):
+        self._sources = {}
+        self._snapshots = {}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add(self, name, fun, interval, initial=None, own_thread=False):
+        self._sources[name] = (fun, interval, own_thread)
+        if initial is not None:
+            self._publish(name, initial)
+
+    def get(self, name, default=None):
+        snap = self._snapshots.get(name)
+        return default if snap is None else snap.value
+
+    def updated_at(self):
+        return {name: snap.updated_at for name, snap in self._snapshots.items()}
+
+    def _publish(self, name, value):
+        snapshots = dict(self._snapshots)
+        snapshots[name] = Snapshot(value, datetime.datetime.now())
+        self._snapshots = snapshots
+
+    def refresh(self, name):
+        fun = self._sources[name][0]
+        try:
+            self._publish(name, fun())
+        except Exception as e:
+            # Keep serving the previous snapshot until the next attempt
+            print(f'refresh of {name} failed: {e!r}')
+
+    def _run(self, names):
+        next_run = {name: time.time() + self._sources[name][1]
+                    for name in names}
+        while not self._stop.is_set():
+            now = time.time()
+            for name in names:
+                if next_run[name] <= now:
+                    self.refresh(name)
+                    next_run[name] = time.time() + self._sources[name][1]
+            self._stop.wait(max(min(next_run.values()) - time.time(), 0.1))
+
+    def start(self):
+        if any(t.is_alive() for t in self._threads):
+            return
+        self._stop.clear()
+        shared = [n for n, (_, _, own) in self._sources.items() if not own]
+        groups = [[n] for n, (_, _, own) in self._sources.items() if own]
+        self._threads = [threading.Thread(target=self._run, args=(names,),
+                                          daemon=True)
+                         for names in ([shared] if shared else []) + groups]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
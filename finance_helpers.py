@@ -1,57 +1,422 @@
 
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
 from scipy.stats import norm
-from scipy import optimize
+from scipy.special import ndtr
+
+
+BS_OUTPUTS = ('price', 'delta', 'gamma', 'vega', 'theta', 'rho')
+
+
+def continuous_rate(selic):
+    return np.log(1 + np.asarray(selic, dtype=float)/100)
+
+
+def _store(out, name, value):
+    # Write into a caller supplied buffer when there is one
+    if name in out:
+        np.copyto(out[name], value)
+    else:
+        out[name] = value
+    return out[name]
+
+
+def bs_kernel(spot, strike, r, T, sigma, iscall, outputs=('price',), out=None):
+    out = {} if out is None else out
+    outputs = set(outputs)
+
+    sqrtT = np.sqrt(T)
+    sigT = sigma * sqrtT
+    d1 = (np.log(spot / strike) + (r + sigma**2/2) * T) / sigT
+    if outputs & {'price', 'delta'}:
+        Nd1 = ndtr(d1)
+    if outputs & {'gamma', 'vega', 'theta'}:
+        dNd1 = norm.pdf(d1)
+    if outputs & {'price', 'theta', 'rho'}:
+        d2 = d1 - sigT
+        PVK = strike * np.exp(-r * T)
+        Nd2 = ndtr(d2)
+    # N(-d2) is only needed by puts' theta and rho
+    if outputs & {'theta', 'rho'}:
+        Nmd2 = ndtr(-d2)
+
+    if 'price' in outputs:
+        call_price = Nd1 * spot - Nd2 * PVK
+        _store(out, 'price', np.where(iscall, call_price,
+                                      PVK - spot + call_price))
+    if 'delta' in outputs:
+        _store(out, 'delta', np.where(iscall, Nd1, Nd1 - 1))
+    if 'gamma' in outputs:
+        _store(out, 'gamma', dNd1 / (spot * sigT))
+    if 'vega' in outputs:
+        _store(out, 'vega', spot * dNd1 * sqrtT)
+    if 'theta' in outputs:
+        decay = -(spot * dNd1 * sigma) / (2*sqrtT)
+        _store(out, 'theta', decay + r * PVK * np.where(iscall, -Nd2, Nmd2))
+    if 'rho' in outputs:
+        _store(out, 'rho', T * PVK * np.where(iscall, Nd2, -Nmd2))
+    return out
+
+
+def bs_price(spot, strike, selic, sigma, days, option_type='call'):
+    return bs_kernel(spot, strike, continuous_rate(selic),
+                     np.asarray(days) / 252, sigma,
+                     np.asarray(option_type) == 'call')['price']
 
 
 def black_scholes(spot, strike, selic, sigma, days, option_type='call', debug=False):
-    r = np.log(1+selic/100)
-    T = days / 252
-    d1 = (np.log(spot / strike) + (r + sigma**2/2) * T) \
-        / (sigma * np.sqrt(T)) 
-    d2 = d1 - sigma * np.sqrt(T)
-    PVK = strike * np.exp(-r * T)
-    Nd1 = norm.cdf(d1)
-    Nd2 = norm.cdf(d2)
-    call_price = Nd1 * spot - Nd2 * PVK
-    put_price = PVK - spot + call_price
-    dNd1 = norm.pdf(d1)
+    r = continuous_rate(selic)
+    T = np.asarray(days) / 252
+    iscall = np.asarray(option_type) == 'call'
+    res = bs_kernel(spot, strike, r, T, sigma, iscall, outputs=BS_OUTPUTS)
     ret = pd.DataFrame()
 
-    iscall = option_type == 'call'
     if debug:
-        ret['d1'] = d1
-        ret['d2'] = d2
-        ret['Nd1'] = Nd1
-        ret['Nd2'] = Nd2
-        ret['PVK'] = PVK
-        ret['sigT'] = sigma * np.sqrt(T)
-    ret['price'] = np.where(iscall, call_price, put_price)
-    ret['gamma'] = dNd1 / (spot * sigma * np.sqrt(T))
-    ret['vega'] = spot * dNd1 * np.sqrt(T)
-    ret['delta'] = np.where(iscall, Nd1, Nd1 - 1)
-    ret['theta'] = np.where(
-        iscall,
-        -(spot * dNd1 * sigma) / (2*np.sqrt(T)) - r * PVK * Nd2,
-        -(spot * dNd1 * sigma) / (2*np.sqrt(T)) - r * PVK * norm.cdf(-d2)
-    )
-    ret['rho'] = np.where(
-        iscall,
-        strike * T * np.exp(-r*T) * Nd2,
-        - strike * T * np.exp(-r*T) * norm.cdf(-d2)
-    )
+        sigT = sigma * np.sqrt(T)
+        d1 = (np.log(spot / strike) + (r + sigma**2/2) * T) / sigT
+        ret['d1'] = np.atleast_1d(d1)
+        ret['d2'] = np.atleast_1d(d1 - sigT)
+        ret['Nd1'] = ndtr(ret['d1'])
+        ret['Nd2'] = ndtr(ret['d2'])
+        ret['PVK'] = np.atleast_1d(strike * np.exp(-r * T))
+        ret['sigT'] = np.atleast_1d(sigT)
+    for col in ['price', 'gamma', 'vega', 'delta', 'theta', 'rho']:
+        ret[col] = np.atleast_1d(np.asarray(res[col]))
     return ret
 
 
+def implied_vol_vec(option_price, spot, strike, selic, days, option_type='call',
+                    tol=1e-8, maxiter=100, vol_min=1e-4, vol_max=10.):
+    # Broadcast everything to a common shape and work on flat arrays
+    price, spot, strike, selic, days, option_type = np.broadcast_arrays(
+        np.asarray(option_price, dtype=float), np.asarray(spot, dtype=float),
+        np.asarray(strike, dtype=float), np.asarray(selic, dtype=float),
+        np.asarray(days, dtype=float), np.asarray(option_type))
+    shape = price.shape
+    price, spot, strike, selic, days = [np.ravel(x) for x in
+        (price, spot, strike, selic, days)]
+    iscall = np.ravel(option_type) == 'call'
+    r = continuous_rate(selic)
+    T = days / 252
+
+    # No-arbitrage bounds: prices outside them have no implied volatility
+    with np.errstate(invalid='ignore'):
+        PVK = strike * np.exp(-r * T)
+        lower = np.maximum(np.where(iscall, spot - PVK, PVK - spot), 0)
+        upper = np.where(iscall, spot, PVK)
+        valid = np.isfinite(price) & (T > 0) & (spot > 0) & (strike > 0) & \
+            (price > lower) & (price < upper)
+
+    # Brenner-Subrahmanyam initial guess, Newton steps safeguarded by bisection
+    lo = np.full(price.shape, vol_min)
+    hi = np.full(price.shape, vol_max)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(2 * np.pi / T) * price / spot
+    sigma = np.where(np.isfinite(sigma), sigma, 0.3)
+    sigma = np.clip(sigma, 2 * vol_min, vol_max / 2)
+    converged = np.zeros(price.shape, dtype=bool)
+    active = valid.copy()
+    for _ in range(maxiter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        s = sigma[idx]
+        res = bs_kernel(spot[idx], strike[idx], r[idx], T[idx], s,
+                        iscall[idx], outputs=('price', 'vega'))
+        p, vega = res['price'], res['vega']
+        diff = p - price[idx]
+        done = np.abs(diff) < tol
+        hi[idx] = np.where(diff > 0, s, hi[idx])
+        lo[idx] = np.where(diff < 0, s, lo[idx])
+        with np.errstate(all='ignore'):
+            step = s - diff / vega
+        bisect = ~np.isfinite(step) | (step <= lo[idx]) | (step >= hi[idx])
+        sigma[idx] = np.where(done, s,
+                              np.where(bisect, (lo[idx] + hi[idx]) / 2, step))
+        converged[idx[done]] = True
+        active[idx[done]] = False
+        # Bracket collapsed without meeting the price tolerance
+        active[idx[hi[idx] - lo[idx] < 1e-12]] = False
+
+    return np.where(converged, sigma, np.nan).reshape(shape)
+
+
 def implied_vol(option_price, spot, strike, selic, days, option_type='call'):
-    if np.isnan(option_price):
-        return np.NaN
-    x = optimize.fsolve(
-        lambda x: (
-            black_scholes(spot, strike, selic, x, days, option_type)['price'] -
-            option_price
-            ),
-        0.02
-    )
-    return x[0]
+    return float(implied_vol_vec(option_price, spot, strike, selic, days,
+                                 option_type))
+
+
+@lru_cache(maxsize=256)
+def _lattice(days, steps):
+    # Time step and terminal node exponents (powers of u) of a CRR tree with
+    # `steps` steps over `days` business days, shared by every series of an
+    # expiry and by every bisection round on it
+    dt = days / 252 / steps
+    j = np.arange(steps + 1) * 2 - steps
+    j.flags.writeable = False
+    return dt, np.sqrt(dt), j
+
+
+def american_kernel(spot, strike, r, T, sigma, iscall, steps=150):
+    # CRR binomial tree batched over options: arrays are (options, nodes).
+    # Returns price, delta, gamma and theta read off the first steps.
+    spot, strike, r, T, sigma, iscall = [np.ravel(x) for x in
+        np.broadcast_arrays(spot, strike, r, T, sigma, iscall)]
+    if spot.size == 0:
+        return {k: np.empty(0) for k in ['price', 'delta', 'gamma', 'theta']}
+    days, inverse = np.unique(np.round(T * 252, 9), return_inverse=True)
+    lattices = [_lattice(float(d), steps) for d in days]
+    dt = np.array([l[0] for l in lattices])[inverse][:, None]
+    sqrt_dt = np.array([l[1] for l in lattices])[inverse][:, None]
+    u = np.exp(sigma[:, None] * sqrt_dt)
+    disc = np.exp(-r[:, None] * dt)
+    p = (np.exp(r[:, None] * dt) - 1/u) / (u - 1/u)
+    up, down = disc * p, disc * (1 - p)
+    sign = np.where(iscall, 1., -1.)[:, None]
+    K = strike[:, None]
+
+    S = spot[:, None] * u ** lattices[0][2]
+    V = np.maximum(sign * (S - K), 0)
+    saved = {}
+    for i in range(steps - 1, -1, -1):
+        V = up * V[:, 1:] + down * V[:, :-1]
+        S = S[:, :-1] * u
+        V = np.maximum(V, sign * (S - K))
+        if i <= 2:
+            saved[i] = (S, V)
+
+    (S1, V1), (S2, V2) = saved[1], saved[2]
+    delta2 = (V2[:, 1:] - V2[:, :-1]) / (S2[:, 1:] - S2[:, :-1])
+    return {
+        'price': V[:, 0],
+        'delta': (V1[:, 1] - V1[:, 0]) / (S1[:, 1] - S1[:, 0]),
+        'gamma': (delta2[:, 1] - delta2[:, 0]) / ((S2[:, 2] - S2[:, 0]) / 2),
+        'theta': (V2[:, 1] - V[:, 0]) / (2 * dt[:, 0]),
+    }
+
+
+def american_greeks(spot, strike, selic, sigma, days, option_type='call',
+                    steps=150, bump=1e-3):
+    # Tree greeks, plus vega and rho by central differences
+    r = continuous_rate(selic)
+    T = np.asarray(days) / 252
+    iscall = np.asarray(option_type) == 'call'
+    ret = american_kernel(spot, strike, r, T, sigma, iscall, steps)
+    price = lambda **kw: american_kernel(
+        spot, strike, kw.get('r', r), T, kw.get('sigma', sigma), iscall,
+        steps)['price']
+    ret['vega'] = (price(sigma=sigma + bump) -
+                   price(sigma=np.maximum(sigma - bump, 1e-6))) / \
+        (sigma + bump - np.maximum(sigma - bump, 1e-6))
+    ret['rho'] = (price(r=r + bump) - price(r=r - bump)) / (2 * bump)
+    return ret
+
+
+def american_implied_vol(option_price, spot, strike, selic, days,
+                         option_type='call', steps=150, tol=1e-6,
+                         maxiter=60, vol_min=1e-4, vol_max=5.):
+    # Vectorized bisection on the tree price; series still open are the only
+    # ones repriced at each iteration
+    price, spot, strike, selic, days, option_type = np.broadcast_arrays(
+        np.asarray(option_price, dtype=float), np.asarray(spot, dtype=float),
+        np.asarray(strike, dtype=float), np.asarray(selic, dtype=float),
+        np.asarray(days, dtype=float), np.asarray(option_type))
+    shape = price.shape
+    price, spot, strike, days = [np.ravel(x) for x in
+        (price, spot, strike, days)]
+    r = continuous_rate(np.ravel(selic))
+    T = days / 252
+    iscall = np.ravel(option_type) == 'call'
+
+    with np.errstate(invalid='ignore'):
+        intrinsic = np.maximum(np.where(iscall, spot - strike, strike - spot), 0)
+        valid = np.isfinite(price) & (T > 0) & (spot > 0) & (strike > 0) & \
+            (price > intrinsic) & (price < np.where(iscall, spot, strike))
+    lo = np.full(price.shape, vol_min)
+    # An american option is worth at least the european one, so its vol is
+    # at most the european IV of the same price; the margin covers the
+    # tree's discretization error
+    hi = implied_vol_vec(price, spot, strike, np.ravel(selic), days,
+                         np.where(iscall, 'call', 'put'))
+    hi = np.where(np.isfinite(hi), np.minimum(1.25 * hi + 0.01, vol_max),
+                  vol_max)
+    sigma = np.full(price.shape, np.nan)
+    active = valid.copy()
+    for _ in range(maxiter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        mid = (lo[idx] + hi[idx]) / 2
+        diff = american_kernel(spot[idx], strike[idx], r[idx], T[idx], mid,
+                               iscall[idx], steps)['price'] - price[idx]
+        hi[idx] = np.where(diff > 0, mid, hi[idx])
+        lo[idx] = np.where(diff <= 0, mid, lo[idx])
+        done = np.abs(diff) < tol
+        sigma[idx[done]] = mid[done]
+        active[idx[done]] = False
+    return sigma.reshape(shape)
+
+
+def implied_distribution(strike, vol, spot, selic, days, width=6,
+                         npoints=2000):
+    # Pricing distribution of the spot at expiry implied by a smile
+    # (Breeden-Litzenberger): vols are interpolated in log-moneyness, flat
+    # past the quoted strikes, and F(K) = 1 + exp(rT) dC/dK. Returns a
+    # price grid and the cdf on it.
+    strike = np.asarray(strike, dtype=float)
+    vol = np.asarray(vol, dtype=float)
+    ok = np.isfinite(strike) & np.isfinite(vol) & (strike > 0) & (vol > 0)
+    # Average the vols quoted at the same strike
+    k, inverse = np.unique(np.log(strike[ok] / spot), return_inverse=True)
+    v = np.bincount(inverse, vol[ok]) / np.bincount(inverse)
+    r = continuous_rate(selic)
+    T = max(float(days), 1) / 252
+    atm = np.interp(0., k, v)
+    x = np.linspace(-width, width, npoints) * atm * np.sqrt(T)
+    grid = spot * np.exp(x)
+    call = bs_kernel(spot, grid, r, T, np.interp(x, k, v), True)['price']
+    cdf = np.clip(1 + np.exp(r * T) * np.gradient(call, grid), 0, 1)
+    return grid, np.maximum.accumulate(cdf)
+
+
+def simulate_paths(spot, sigma, days, npaths, rng=None, antithetic=False,
+                   dtype=np.float64):
+    # Driftless GBM with daily steps, shaped (days, npaths)
+    rng = np.random.default_rng(rng)
+    n = (npaths + 1) // 2 if antithetic else npaths
+    z = rng.standard_normal((days, n), dtype=dtype)
+    if antithetic:
+        z = np.concatenate([z, -z], axis=1)[:, :npaths]
+    z *= dtype(sigma / np.sqrt(252))
+    np.cumsum(z, axis=0, out=z)
+    np.exp(z, out=z)
+    z *= dtype(spot)
+    return z
+
+
+def montecarlo(spot, strike, option_type, vol, qty, spot_qty, cost, selic,
+               days, sigma, npaths=10000, seed=None, antithetic=False,
+               dtype=np.float64, chunk_size=None, max_bytes=64 * 2**20,
+               percentiles=(5, 25, 50, 75, 95), nplot=100):
+    strike = np.asarray(strike, dtype=dtype)
+    iscall = np.asarray(option_type) == 'call'
+    vol = np.asarray(vol, dtype=dtype)
+    qty = np.asarray(qty, dtype=dtype)
+    r = continuous_rate(selic)
+    if days < 1:
+        # Expiring today: a single row with every path at the expiry payoff
+        value = spot * spot_qty + np.maximum(
+            np.where(iscall, spot - strike, strike - spot), 0) @ qty - cost
+        pnl = np.full((1, npaths), value, dtype=dtype)
+        days_left = np.zeros(1, dtype=int)
+    else:
+        # Row k of the paths is revalued with days - k business days left
+        days_left = np.arange(days, 0, -1)
+        T = (days_left / 252).astype(dtype)[:, None, None]
+        # bs_kernel keeps about a dozen (days, paths, legs) temporaries alive,
+        # so the number of paths per chunk comes from the memory budget
+        per_path = 12 * np.dtype(dtype).itemsize * days * max(len(strike), 1)
+        n_chunk = max(int(max_bytes // per_path), 1)
+        if chunk_size is not None:
+            n_chunk = min(n_chunk, chunk_size)
+
+        rng = np.random.default_rng(seed)
+        pnl = np.empty((days, npaths), dtype=dtype)
+        for start in range(0, npaths, n_chunk):
+            n = min(n_chunk, npaths - start)
+            paths = simulate_paths(spot, sigma, days, n, rng, antithetic, dtype)
+            # Broadcast (days, paths, 1) against the legs on the last axis
+            prices = bs_kernel(paths[:, :, None], strike, r, T, vol,
+                               iscall)['price']
+            pnl[:, start:start + n] = paths * spot_qty + prices @ qty - cost
+
+    return {
+        'days_left': days_left,
+        'percentiles': dict(zip(percentiles,
+                                np.percentile(pnl, percentiles, axis=1))),
+        'mean': pnl.mean(axis=1),
+        'prob_profit': (pnl > 0).mean(axis=1),
+        'paths': pnl[:, :nplot],
+    }
+
+
+def payoff_grid(knots, lo, hi, step=0.01, window=None, npoints=500):
+    # Dense sampling around strikes and spot, sparse elsewhere. The expiry
+    # payoff is piecewise linear with kinks at the strikes, so it is exact at
+    # any grid that contains them.
+    knots = np.asarray(knots, dtype=float)
+    window = (hi - lo) / 50 if window is None else window
+    dense_step = max(step, 2 * window / 100)
+    dense = (knots[:, None] + np.arange(-window, window, dense_step)).ravel()
+    grid = np.concatenate([np.linspace(lo, hi, npoints), dense, knots])
+    return np.unique(np.clip(grid, lo, hi))
+
+
+def payoff_stats(strike, option_type, qty, spot_qty, cost):
+    # Breakevens and extremes of the expiry payoff over spot >= 0, from its
+    # values at the kinks and the slope of the right tail
+    strike = np.asarray(strike, dtype=float)
+    iscall = np.asarray(option_type) == 'call'
+    qty = np.asarray(qty, dtype=float)
+    knots = np.unique(np.concatenate([[0.], strike]))
+    values = np.maximum(
+        np.where(iscall, knots[:, None] - strike, strike - knots[:, None]),
+        0) @ qty + spot_qty * knots - cost
+    slope = spot_qty + qty[iscall].sum()
+
+    x0, x1, y0, y1 = knots[:-1], knots[1:], values[:-1], values[1:]
+    cross = (y0 * y1 < 0) | ((y1 == 0) & (y0 != 0))
+    breakevens = list(x0[cross] - y0[cross] * (x1 - x0)[cross] /
+                      (y1 - y0)[cross])
+    if values[0] == 0:
+        breakevens.insert(0, 0.)
+    if values[-1] * slope < 0:
+        breakevens.append(knots[-1] - values[-1] / slope)
+
+    return {
+        'breakevens': np.array(breakevens),
+        'max_gain': np.inf if slope > 0 else values.max(),
+        'max_loss': -np.inf if slope < 0 else values.min(),
+    }
+
+
+def chain_analytics(df, spot, selic, days):
+    # Extrinsic value, implied vol and greeks for a chain with quotes
+    df = df.copy()
+    df['VE'] = df['cotacao'] - df['VI']
+    df['Vol'] = implied_vol_vec(df['cotacao'].values, spot,
+        df['strike'].values, selic, days, df['tipo_opcao'].values)
+    gregas = bs_kernel(spot, df['strike'].values, continuous_rate(selic),
+        days / 252, df['Vol'].values, df['tipo_opcao'].values == 'call',
+        outputs=['delta', 'gamma', 'vega', 'theta', 'rho'])
+    for col in ['delta', 'gamma', 'vega', 'theta', 'rho']:
+        df[col] = gregas[col]
+
+    # American puts are repriced on the binomial tree. Without dividends an
+    # american call is never exercised early, so black-scholes already holds.
+    if 'tipo_exercicio' in df:
+        am = (df['tipo_exercicio'].astype(str).str.lower() == 'americano').values & \
+            (df['tipo_opcao'].values != 'call')
+        if am.any():
+            d = np.broadcast_to(days, am.shape)[am]
+            vol = american_implied_vol(df['cotacao'].values[am], spot,
+                df['strike'].values[am], selic, d, df['tipo_opcao'].values[am])
+            gregas = american_greeks(spot, df['strike'].values[am], selic, vol,
+                                     d, df['tipo_opcao'].values[am])
+            df.loc[am, 'Vol'] = vol
+            for col in ['delta', 'gamma', 'vega', 'theta', 'rho']:
+                df.loc[am, col] = gregas[col]
+    return df
+
+
+def vol_surface(df, spot, selic, days):
+    # IV and greeks for every series of an underlying in one pass. `days`
+    # holds the business days to expiry of each row.
+    df = df.copy()
+    df['dias'] = days
+    df['moneyness'] = np.log(df['strike'] / spot)
+    df['VI'] = np.maximum(np.where(df['tipo_opcao'] == 'call',
+                                   spot - df['strike'], df['strike'] - spot), 0)
+    return chain_analytics(df, spot, selic, df['dias'].values)
@@ -0,0 +1,217 @@
+import os
+import shutil
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_helpers import CACHE_DIR, file_lock, write_columnar, read_columnar
+from finance_helpers import bs_price, implied_vol_vec
+
+
+HISTORY_DIR = os.environ.get('HISTORY_DIR', os.path.join(CACHE_DIR, 'history'))
+# Columns kept per kind; one columnar partition per kind and month
+HISTORY_COLUMNS = {
+    'chains': ['data', 'ativo', 'ticker', 'tipo_opcao', 'strike',
+               'vencimento', 'cotacao'],
+    'spots': ['data', 'ativo', 'cotacao'],
+}
+
+
+def _partition(root, kind, month):
+    return os.path.join(root, kind, str(month))
+
+
+def history_lock(root, name, blocking=True):
+    # Cross-process lock under the archive; yields False when non-blocking
+    # and another process holds it
+    return file_lock(os.path.join(root, f'.{name}.lock'), blocking)
+
+
+def last_archived(root=HISTORY_DIR):
+    try:
+        with open(os.path.join(root, 'last_archived')) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def archive_day(day, chains, spots, root=HISTORY_DIR):
+    # Adds one day of chain quotes and underlying closes to the archive.
+    # Re-archiving a day replaces its rows, so a daily job can be rerun.
+    day = np.datetime64(day, 'D')
+    for kind, df in [('chains', chains), ('spots', spots)]:
+        df = df.assign(data=day)[HISTORY_COLUMNS[kind]]
+        month = day.astype('datetime64[M]')
+        path = _partition(root, kind, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Read-modify-write of a month is serialized across workers
+        with history_lock(root, f'{kind}-{month}'):
+            if os.path.exists(path):
+                old = read_columnar(path, mmap=False)
+                df = pd.concat([old[old['data'] != day], df],
+                               ignore_index=True)
+            df = df.sort_values(['data', 'ativo']).reset_index(drop=True)
+            df['data'] = pd.to_datetime(df['data'])
+            if kind == 'chains':
+                df['vencimento'] = pd.to_datetime(df['vencimento'])
+            for col in ['ativo', 'ticker', 'tipo_opcao']:
+                if col in df:
+                    df[col] = df[col].astype(str).astype('category')
+            # Write aside and swap, readers never see a half-written month
+            tmp = f'{path}.{os.getpid()}.tmp'
+            trash = f'{path}.{os.getpid()}.old'
+            shutil.rmtree(tmp, ignore_errors=True)
+            write_columnar(df, tmp)
+            if os.path.exists(path):
+                os.replace(path, trash)
+            os.replace(tmp, path)
+            shutil.rmtree(trash, ignore_errors=True)
+    with open(os.path.join(root, 'last_archived'), 'w') as f:
+        f.write(str(day))
+
+
+def archived_months(kind='spots', root=HISTORY_DIR):
+    path = os.path.join(root, kind)
+    if not os.path.exists(path):
+        return []
+    return sorted(d for d in os.listdir(path)
+                  if not d.endswith(('.tmp', '.old', '.lock')))
+
+
+def load_history(kind, ativo=None, start=None, end=None, tickers=None,
+                 root=HISTORY_DIR):
+    # Filters run on the memory-mapped columns of each partition; only the
+    # rows that pass them are copied into the frame
+    start = np.datetime64(start or '1900-01-01', 'D')
+    end = np.datetime64(end or '2200-01-01', 'D')
+
+    def where(data):
+        mask = (data['data'] >= start) & \
+            (data['data'] < end + np.timedelta64(1, 'D'))
+        if ativo is not None:
+            mask &= np.asarray(data['ativo'] == ativo)
+        if tickers is not None:
+            mask &= np.asarray(data['ticker'].isin(tickers))
+        return mask
+
+    frames = []
+    for month in archived_months(kind, root):
+        m = np.datetime64(month, 'M')
+        if m < start.astype('datetime64[M]') or m > end.astype('datetime64[M]'):
+            continue
+        frames.append(read_columnar(_partition(root, kind, month), where=where))
+    if not frames:
+        return pd.DataFrame(columns=HISTORY_COLUMNS[kind])
+    return pd.concat(frames, ignore_index=True)
+
+
+def backtest(legs, spot_qty, ativo, start=None, end=None, selic=0.,
+             calendar=None, vol=0.3, root=HISTORY_DIR):
+    # Replays a position over the archive: legs are options_table rows with
+    # a vencimento and a nonzero posicao. Days without a stored quote are
+    # repriced with black-scholes at the leg's last implied vol so far, or
+    # at its Vol (else `vol`) before its first quote; later quotes are never
+    # used, so there is no look-ahead.
+    legs = pd.DataFrame(legs)
+    legs = legs[legs['posicao'] != 0].reset_index(drop=True)
+    spots = load_history('spots', ativo, start, end, root=root)
+    spots = spots.groupby('data')['cotacao'].last().dropna()
+    if not len(spots):
+        return pd.DataFrame(columns=['spot', 'valor', 'pnl'])
+    if len(legs):
+        last = pd.to_datetime(legs['vencimento']).max()
+        spots = spots[spots.index <= last]
+
+    dates = spots.index.values.astype('datetime64[D]')
+    spot = spots.values.astype(float)
+    quotes = load_history('chains', ativo, dates[0], dates[-1],
+                          tickers=list(legs['ticker']), root=root)
+    prices = quotes.pivot_table(index='data', columns='ticker',
+                                values='cotacao', aggfunc='last',
+                                observed=True)
+    prices = prices.reindex(index=spots.index,
+                            columns=list(legs['ticker'])).values
+
+    strike = legs['strike'].values.astype(float)
+    tipo = legs['tipo_opcao'].values
+    venc = pd.to_datetime(legs['vencimento']).values.astype('datetime64[D]')
+    if calendar is None:
+        days = np.busday_count(dates[:, None], venc[None, :])
+    else:
+        days = calendar.count(dates[:, None], venc[None, :])
+    days = np.maximum(days, 0).astype(float)
+
+    iv = implied_vol_vec(prices, spot[:, None], strike, selic,
+                         np.maximum(days, 1), tipo)
+    fallback = pd.to_numeric(legs['Vol'], errors='coerce') if 'Vol' in legs \
+        else pd.Series(np.nan, index=legs.index)
+    iv = pd.DataFrame(iv).ffill().fillna(fallback.fillna(vol)).values
+    model = bs_price(spot[:, None], strike, selic, iv, np.maximum(days, 1), tipo)
+    intrinsic = np.where(tipo == 'call', np.maximum(spot[:, None] - strike, 0),
+                         np.maximum(strike - spot[:, None], 0))
+    prices = np.where(days <= 0, intrinsic,
+                      np.where(np.isnan(prices), model, prices))
+
+    qty = legs['posicao'].values.astype(float)
+    value = prices @ qty + spot_qty * spot
+    res = pd.DataFrame({'spot': spot, 'valor': value,
+                        'pnl': value - value[0]}, index=spots.index)
+    for i, ticker in enumerate(legs['ticker']):
+        res[ticker] = prices[:, i]
+    return res
+
+
+def _run_backtest(name, kwargs):
+    return name, backtest(**kwargs)
+
+
+def run_backtests(jobs, processes=None, **kwargs):
+    # jobs maps a name to backtest() arguments; each runs in its own process
+    # and maps the archive partitions it reads
+    start = datetime.datetime.now()
+    results = {}
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_run_backtest, name, dict(kwargs, **job))
+                   for name, job in jobs.items()]
+        for future in futures:
+            name, res = future.result()
+            results[name] = res
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    print(f'backtested {len(results)} strategies in {elapsed:.1f}s')
+    return results
+
+
+def generate_history(root, underlyings=('BOVA', 'PETR'), start='2020-01-02',
+                     ndays=252, nstrikes=10, selic=13.65, missing=0.2, seed=0):
+    # Synthetic archive: GBM closes, monthly expiries and black-scholes quotes
+    # with a fraction of them missing, like illiquid series
+    rng = np.random.default_rng(seed)
+    dates = np.busday_offset(np.datetime64(start, 'D'), np.arange(ndays),
+                             roll='forward')
+    vencims = np.busday_offset(dates[0], np.arange(21, ndays + 63, 21),
+                               roll='forward')
+    closes = {a: 100 * np.exp(np.cumsum(rng.normal(0, 0.3 / np.sqrt(252), ndays)))
+              for a in underlyings}
+    series = []
+    for a in underlyings:
+        s0 = closes[a][0]
+        for venc in vencims:
+            for k in np.round(s0 * np.linspace(0.8, 1.2, nstrikes), 2):
+                for tipo in ['call', 'put']:
+                    series.append((a, f'{a}{tipo[0].upper()}{venc}{k:g}',
+                                   tipo, k, venc))
+    series = pd.DataFrame(series, columns=['ativo', 'ticker', 'tipo_opcao',
+                                           'strike', 'vencimento'])
+    for i, day in enumerate(dates):
+        chain = series[series['vencimento'].values > day].copy()
+        spot = chain['ativo'].map({a: c[i] for a, c in closes.items()}).values
+        days = np.busday_count(day, chain['vencimento'].values.astype('datetime64[D]'))
+        chain['cotacao'] = bs_price(spot, chain['strike'].values, selic, 0.3,
+                                    days, chain['tipo_opcao'].values).round(2)
+        chain.loc[rng.random(len(chain)) < missing, 'cotacao'] = np.nan
+        spots = pd.DataFrame({'ativo': list(closes),
+                              'cotacao': [c[i] for c in closes.values()]})
+        archive_day(day, chain, spots, root)
+    return series
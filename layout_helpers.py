@@ -1,4 +1,5 @@
 
+import numpy as np
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
@@ -61,3 +62,26 @@ def gen_card(text, id=None, title='', cardClass='border-light',
 
 def spinner_graph(*args, **kwargs):
     return dbc.Spinner(dcc.Graph(*args, **kwargs))
+
+
+def minmax_indices(y, max_points=400):
+    # Indices that keep the min and max of every bucket of each series in y
+    # (1 or 2-d, last axis is x), plus both endpoints
+    y = np.atleast_2d(y)
+    n = y.shape[-1]
+    if n <= max_points:
+        return np.arange(n)
+    nbuckets = max(max_points // (2 * y.shape[0]), 1)
+    edges = np.linspace(0, n, nbuckets + 1).astype(int)
+    idx = [0, n - 1]
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        chunk = np.nan_to_num(y[:, lo:hi])
+        idx.extend(lo + chunk.argmin(axis=1))
+        idx.extend(lo + chunk.argmax(axis=1))
+    return np.unique(idx)
+
+
+def to_list(a, decimals=4):
+    # Compact JSON arrays for dcc.Store, NaN as null
+    a = np.round(np.asarray(a, dtype=float), decimals)
+    return np.where(np.isnan(a), None, a).tolist()
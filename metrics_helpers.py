@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from collections import defaultdict, Counter
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _fmt(name, labels, value):
+    if labels:
+        name += '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+    return f'{name} {value}'
+
+
+class Metrics:
+    # Counters and count/sum summaries in Prometheus text format. Caches
+    # registered with register_cache must have a stats() method returning
+    # hits and misses.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = defaultdict(float)
+        self.summaries = defaultdict(lambda: [0, 0.])
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        if self.enabled:
+            with self._lock:
+                self.counters[name, _labels(labels)] += value
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            with self._lock:
+                summary = self.summaries[name, _labels(labels)]
+                summary[0] += 1
+                summary[1] += value
+
+    @contextmanager
+    def stage(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start,
+                         stage=name, **labels)
+
+    def register_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            summaries = sorted(self.summaries.items())
+        for name in sorted({n for (n, _), _ in counters}):
+            lines.append(f'# TYPE {name} counter')
+            lines += [_fmt(name, l, v) for (n, l), v in counters if n == name]
+        for name in sorted({n for (n, _), _ in summaries}):
+            lines.append(f'# TYPE {name} summary')
+            for (n, l), (count, total) in summaries:
+                if n == name:
+                    lines.append(_fmt(f'{name}_count', l, count))
+                    lines.append(_fmt(f'{name}_sum', l, total))
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        for name, kind in [('cache_hits_total', 'counter'),
+                           ('cache_misses_total', 'counter'),
+                           ('cache_hit_ratio', 'gauge')]:
+            if stats:
+                lines.append(f'# TYPE {name} {kind}')
+            for cache, s in sorted(stats.items()):
+                total = s['hits'] + s['misses']
+                value = {'cache_hits_total': s['hits'],
+                         'cache_misses_total': s['misses'],
+                         'cache_hit_ratio': s['hits'] / total if total else 0}
+                lines.append(_fmt(name, (('cache', cache),), value[name]))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(enabled=os.environ.get('METRICS', '1') == '1')
+measure_payload = os.environ.get('METRICS_PAYLOAD', '0') == '1'
+
+
+def instrument_callback(fun):
+    # Times a Dash callback. Measuring the payload size means serializing
+    # the output a second time, so it is only done with METRICS_PAYLOAD=1.
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            ret = fun(*args, **kwargs)
+        except Exception:
+            metrics.inc('callback_errors_total', callback=fun.__name__)
+            raise
+        metrics.observe('callback_seconds', time.perf_counter() - start,
+                        callback=fun.__name__)
+        if measure_payload and metrics.enabled:
+            from plotly.utils import PlotlyJSONEncoder
+            metrics.observe('callback_payload_bytes',
+                            len(json.dumps(ret, cls=PlotlyJSONEncoder)),
+                            callback=fun.__name__)
+        return ret
+    return wrapper
+
+
+class SamplingProfiler:
+    # Samples the stacks of all other threads every `interval` seconds and
+    # counts them in collapsed form, ready for flamegraph.pl / speedscope.
+    # Past max_stacks distinct stacks, new ones are counted as one bucket.
+    def __init__(self, interval=0.01, max_stacks=10000):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ' +
+                                 f'({os.path.basename(code.co_filename)}:' +
+                                 f'{frame.f_lineno})')
+                    frame = frame.f_back
+                stack = ';'.join(reversed(stack))
+                with self._lock:
+                    if stack not in self.stacks and \
+                            len(self.stacks) >= self.max_stacks:
+                        stack = '[truncated]'
+                    self.stacks[stack] += 1
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def reset(self):
+        with self._lock:
+            self.stacks.clear()
+
+    def collapsed(self):
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return '\n'.join(f'{s} {n}' for s, n in stacks) + '\n'
+
+
+profiler = SamplingProfiler(float(os.environ.get('PROFILE_INTERVAL', 0.01)),
+                            int(os.environ.get('PROFILE_MAX_STACKS', 10000)))
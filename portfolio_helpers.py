@@ -0,0 +1,146 @@
+import copy
+import hashlib
+import threading
+
+import numpy as np
+import pandas as pd
+
+from finance_helpers import (BS_OUTPUTS, bs_kernel, bs_price, continuous_rate,
+                             montecarlo, payoff_stats)
+
+
+class Portfolio:
+    # Option legs as parallel arrays plus the underlying as its own leg.
+    # Curves are kept per leg for unit quantity and shared by every view
+    # from with_quantities(); quantities only live in the view, so a cached
+    # portfolio is never changed by a request.
+    def __init__(self, strike, option_type, vol, qty, premium, spot,
+                 spot_qty=0, selic=0, days=0, tickers=None, sim_vol=None):
+        self.strike = np.asarray(strike, dtype=float)
+        self.is_call = np.asarray(option_type) == 'call'
+        self.vol = np.asarray(vol, dtype=float)
+        self.qty = np.asarray(qty, dtype=float).copy()
+        self.premium = np.asarray(premium, dtype=float)
+        self.tickers = tickers
+        self.spot = spot
+        self.spot_qty = spot_qty
+        self.selic = selic
+        self.days = days
+        self.sim_vol = np.nanmax(self.vol) if sim_vol is None else sim_vol
+        self._shared = {'curves': {}, 'lock': threading.Lock()}
+
+    @classmethod
+    def from_records(cls, records, spot, spot_qty, selic, days):
+        # Rows of options_table: blank positions count as zero, missing vols
+        # and quotes are filled with the chain's median vol
+        df = pd.DataFrame(records)
+        sim_vol = df['Vol'].max()
+        vol = df['Vol'].fillna(df['Vol'].median()).values
+        premium = np.where(df['cotacao'].isnull(),
+                           bs_price(spot, df['strike'].values, selic, vol,
+                                    days, df['tipo_opcao'].values),
+                           df['cotacao'])
+        return cls(df['strike'], df['tipo_opcao'], vol,
+                   cls.quantities(records), premium, spot, spot_qty or 0,
+                   selic, days, list(df['ticker']), sim_vol)
+
+    @staticmethod
+    def quantities(records):
+        return pd.to_numeric(pd.Series([r['posicao'] for r in records],
+                                       dtype=object).replace('', 0)) \
+            .fillna(0).values.astype(float)
+
+    def with_quantities(self, qty, spot_qty=None):
+        # Same legs and shared unit curves, own quantities
+        view = copy.copy(self)
+        view.qty = np.asarray(qty, dtype=float).copy()
+        view.spot_qty = self.spot_qty if spot_qty is None else spot_qty
+        return view
+
+    @property
+    def option_type(self):
+        return np.where(self.is_call, 'call', 'put')
+
+    @property
+    def active(self):
+        return self.qty != 0
+
+    @property
+    def cost(self):
+        return self.qty @ self.premium + self.spot_qty * self.spot
+
+    def leg_values(self, spots, days):
+        # (spots, legs) value of one unit of each leg
+        spots = np.asarray(spots, dtype=float)[..., None]
+        if days <= 0:
+            return np.maximum(np.where(self.is_call, spots - self.strike,
+                                       self.strike - spots), 0)
+        return bs_kernel(spots, self.strike, continuous_rate(self.selic),
+                         days / 252, self.vol, self.is_call)['price']
+
+    def value(self, spots, days):
+        return self.leg_values(spots, days) @ self.qty + \
+            self.spot_qty * np.asarray(spots, dtype=float)
+
+    def pnl(self, spots, days):
+        return self.value(spots, days) - self.cost
+
+    def curves(self, x, days_list):
+        # P&L over the grid x for each number of days left in days_list
+        key = (x[0], x[-1], len(x), tuple(days_list))
+        with self._shared['lock']:
+            unit = self._shared['curves'].get(key)
+        if unit is None:
+            unit = {d: self.leg_values(x, d) for d in days_list}
+            with self._shared['lock']:
+                # Only the latest grid is kept
+                self._shared['curves'] = {key: unit}
+        base = self.spot_qty * x - self.cost
+        return {d: unit[d] @ self.qty + base for d in days_list}
+
+    def greeks(self, spot=None, days=None):
+        spot = self.spot if spot is None else spot
+        days = self.days if days is None else days
+        res = bs_kernel(spot, self.strike, continuous_rate(self.selic),
+                        days / 252, self.vol, self.is_call, outputs=BS_OUTPUTS)
+        ret = {k: np.nan_to_num(res[k]) @ self.qty for k in BS_OUTPUTS}
+        ret['delta'] += self.spot_qty
+        return ret
+
+    def stats(self):
+        return payoff_stats(self.strike, self.option_type, self.qty,
+                            self.spot_qty, self.cost)
+
+    def simulate(self, **kwargs):
+        legs = self.active
+        return montecarlo(self.spot, self.strike[legs], self.option_type[legs],
+                          self.vol[legs], self.qty[legs], self.spot_qty,
+                          self.cost, self.selic, self.days, self.sim_vol,
+                          **kwargs)
+
+    def signature(self):
+        # Changes whenever anything that affects valuation changes
+        h = hashlib.sha1()
+        for a in [self.strike, self.is_call, self.vol, self.qty, self.premium,
+                  np.array([self.spot, self.spot_qty, self.selic, self.days],
+                           dtype=float)]:
+            h.update(np.ascontiguousarray(a).tobytes())
+        return h.hexdigest()
+
+    def scenario_cube(self, spot_moves, days, vol_shifts, skew=0.):
+        # Revalues the portfolio over spot moves x days left x IV shifts in
+        # one broadcast pass. Shifted vols are vol + shift + skew*ln(K/spot).
+        # Returns P&L and greek cubes shaped (spots, days, shifts).
+        spots = self.spot * (1 + np.asarray(spot_moves, dtype=float))
+        T = np.maximum(np.asarray(days, dtype=float), 1e-3) / 252
+        vol = self.vol + np.asarray(vol_shifts, dtype=float)[:, None] + \
+            skew * np.log(self.strike / self.spot)
+        res = bs_kernel(spots[:, None, None, None], self.strike,
+                        continuous_rate(self.selic), T[None, :, None, None],
+                        np.maximum(vol, 1e-4)[None, None], self.is_call,
+                        outputs=['price', 'delta', 'gamma', 'vega', 'theta'])
+        cube = {k: np.nan_to_num(v) @ self.qty for k, v in res.items()}
+        cube['pnl'] = cube.pop('price') + \
+            self.spot_qty * spots[:, None, None] - self.cost
+        cube['delta'] = cube['delta'] + self.spot_qty
+        return cube
@@ -0,0 +1,134 @@
+import os
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed, TimeoutError
+
+import numpy as np
+import pandas as pd
+
+from data_helpers import file_lock
+from finance_helpers import vol_surface
+
+
+def screen_underlying(ticker, spot, chain, selic):
+    # One row per expiry: ATM vol, put/call skew and cheapest extrinsic value
+    surf = vol_surface(chain, spot, selic, chain['dias'].values)
+    surf = surf[np.isfinite(surf['Vol'])]
+    rows = []
+    for vencimento, df in surf.groupby('vencimento'):
+        calls = df[df['tipo_opcao'] == 'call']
+        puts = df[df['tipo_opcao'] == 'put']
+        atm = df.iloc[np.argsort(np.abs(df['moneyness'].values))[:2]]
+        skew = np.nan
+        if len(calls) and len(puts):
+            put = puts.iloc[np.argmin(np.abs(puts['strike'].values - 0.9*spot))]
+            call = calls.iloc[np.argmin(np.abs(calls['strike'].values - 1.1*spot))]
+            skew = put['Vol'] - call['Vol']
+        ve = df[df['VE'] > 0]
+        cheapest = ve.iloc[np.argmin(ve['VE'].values)] if len(ve) else None
+        rows.append({
+            'ativo': ticker,
+            'vencimento': vencimento,
+            'dias': int(df['dias'].iloc[0]),
+            'spot': spot,
+            'series': len(df),
+            'atm_vol': atm['Vol'].mean(),
+            'skew': skew,
+            've_ticker': None if cheapest is None else cheapest['ticker'],
+            've_pct': np.nan if cheapest is None
+                      else 100 * cheapest['VE'] / spot,
+        })
+    return rows
+
+
+def update_iv_history(fn, atm_vols, today=None, window=252):
+    # Daily front-month ATM vol per underlying, the basis of the IV rank
+    today = str(today or datetime.date.today())
+    new = pd.DataFrame({'data': today, 'ativo': list(atm_vols.keys()),
+                        'atm_vol': list(atm_vols.values())})
+    # Read-modify-write under a lock, written aside and swapped in so
+    # readers never see a partial file
+    with file_lock(f'{fn}.lock'):
+        hist = pd.read_csv(fn) if os.path.exists(fn) else new.iloc[:0]
+        # Only the underlyings screened this time are replaced; a partial
+        # run keeps the rows the others got earlier today
+        stale = (hist['data'] == today) & hist['ativo'].isin(new['ativo'])
+        hist = pd.concat([hist[~stale], new])
+        hist = hist.groupby('ativo').tail(window)
+        tmp = f'{fn}.{os.getpid()}.tmp'
+        hist.to_csv(tmp, index=False)
+        os.replace(tmp, fn)
+    stats = hist.groupby('ativo')['atm_vol'].agg(['min', 'max'])
+    rank = (pd.Series(atm_vols) - stats['min']) / (stats['max'] - stats['min'])
+    return (100 * rank).to_dict()
+
+
+def run_screener(chains, spots, selic, calendar, get_quotes,
+                 history_fn=None, processes=None, chunk=10, timeout=300,
+                 quote_timeout=None):
+    # Quotes are fetched a few underlyings at a time while earlier chunks are
+    # already being screened by the process pool. Quoting stops after
+    # `quote_timeout` seconds (default `timeout`); screening then gets its
+    # own `timeout`. Underlyings not done by then are left out of this run,
+    # and rows finished along the way are kept.
+    start = datetime.datetime.now()
+    elapsed = lambda: (datetime.datetime.now() - start).total_seconds()
+    quote_timeout = timeout if quote_timeout is None else quote_timeout
+    tasks = [(t, s) for t, s in spots.items() if np.isfinite(s) and s > 0]
+    rows = []
+    pool = ProcessPoolExecutor(processes)
+    futures = []
+
+    def harvest():
+        for future in [f for f in futures if f.done()]:
+            futures.remove(future)
+            try:
+                rows.extend(future.result())
+            except Exception as e:
+                print(f'screener task failed: {e!r}')
+
+    try:
+        for i in range(0, len(tasks), chunk):
+            if elapsed() > quote_timeout:
+                print(f'screener quoting timed out after {i} underlyings')
+                break
+            batch = [(t, s, chains.underlying(t[:4])) for t, s in tasks[i:i+chunk]]
+            batch = [(t, s, c) for t, s, c in batch if len(c)]
+            if not batch:
+                continue
+            tickers = np.concatenate([c['ticker'].values for _, _, c in batch])
+            quotes = get_quotes(tickers)[['ticker', 'cotacao']]
+            for t, s, chain in batch:
+                chain = pd.merge(chain, quotes, on='ticker', how='inner')
+                dias = {v: calendar.days_to(v) for v in chain['vencimento'].unique()}
+                chain['dias'] = chain['vencimento'].map(dias).astype(float)
+                chain = chain[(chain['dias'] > 0) & chain['cotacao'].notnull()]
+                if len(chain):
+                    futures.append(pool.submit(screen_underlying, t, s,
+                                               chain, selic))
+            harvest()
+        try:
+            for future in as_completed(list(futures), timeout=timeout):
+                futures.remove(future)
+                try:
+                    rows.extend(future.result())
+                except Exception as e:
+                    print(f'screener task failed: {e!r}')
+        except TimeoutError:
+            print(f'screener timed out, {len(rows)} rows done')
+    finally:
+        # Do not wait for stragglers; their rows are dropped
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    df = pd.DataFrame(rows, columns=['ativo', 'vencimento', 'dias', 'spot',
+        'series', 'atm_vol', 'skew', 've_ticker', 've_pct'])
+    df = df.sort_values(['ativo', 'vencimento']).reset_index(drop=True)
+    if history_fn is not None and len(df):
+        front = df.groupby('ativo')['atm_vol'].first().dropna()
+        df['iv_rank'] = df['ativo'].map(update_iv_history(history_fn,
+                                                           front.to_dict()))
+    else:
+        df['iv_rank'] = np.nan
+    print(f'screened {df["ativo"].nunique()} underlyings in {elapsed():.1f}s')
+    return df
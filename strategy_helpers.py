@@ -0,0 +1,184 @@
+import os
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from scipy.special import ndtr
+
+from finance_helpers import continuous_rate, implied_distribution
+
+
+STRATEGY_KINDS = ('vertical', 'straddle', 'strangle', 'condor', 'ratio')
+
+
+def _pairs(idx, strike):
+    # All (i, j) with strike[i] < strike[j] among the positions in idx
+    i, j = np.triu_indices(len(idx), 1)
+    i, j = idx[i], idx[j]
+    swap = strike[i] > strike[j]
+    i, j = np.where(swap, j, i), np.where(swap, i, j)
+    keep = strike[i] < strike[j]
+    return i[keep], j[keep]
+
+
+def enumerate_strategies(strike, is_call, spot, kinds=STRATEGY_KINDS):
+    # Quantity matrix of candidate structures, one row per candidate and
+    # one column per series of the chain, with both long and short sides
+    strike = np.asarray(strike, dtype=float)
+    is_call = np.asarray(is_call, dtype=bool)
+    n = len(strike)
+    calls, puts = np.flatnonzero(is_call), np.flatnonzero(~is_call)
+    names, rows = [], []
+
+    def add(name, legs, suffix='o'):
+        # legs: list of (index array, quantity) with equal-length indices
+        q = np.zeros((len(legs[0][0]), n))
+        for idx, qty in legs:
+            np.add.at(q, (np.arange(len(idx)), idx), qty)
+        for sign, side in [(1, 'comprad'), (-1, 'vendid')]:
+            names.extend([f'{name} {side}{suffix}'] * len(q))
+            rows.append(sign * q)
+
+    if 'vertical' in kinds:
+        for idx, tipo in [(calls, 'call'), (puts, 'put')]:
+            i, j = _pairs(idx, strike)
+            # Long the lower strike of a call spread and the higher of a put
+            lo, hi = (i, j) if tipo == 'call' else (j, i)
+            add(f'trava de {tipo}', [(lo, 1), (hi, -1)], 'a')
+    if 'straddle' in kinds or 'strangle' in kinds:
+        ci, pi = np.meshgrid(calls, puts, indexing='ij')
+        ci, pi = ci.ravel(), pi.ravel()
+        same = strike[ci] == strike[pi]
+        if 'straddle' in kinds:
+            add('straddle', [(ci[same], 1), (pi[same], 1)])
+        if 'strangle' in kinds:
+            otm = (strike[pi] < spot) & (strike[ci] > spot)
+            add('strangle', [(ci[otm], 1), (pi[otm], 1)])
+    if 'condor' in kinds:
+        # Iron condors on out of the money strikes; the long side buys the
+        # inner strikes
+        pl, ph = _pairs(puts[strike[puts] < spot], strike)
+        cl, ch = _pairs(calls[strike[calls] > spot], strike)
+        a, b = np.meshgrid(np.arange(len(pl)), np.arange(len(cl)),
+                           indexing='ij')
+        a, b = a.ravel(), b.ravel()
+        add('condor', [(pl[a], -1), (ph[a], 1), (cl[b], 1), (ch[b], -1)])
+    if 'ratio' in kinds:
+        for idx, tipo in [(calls, 'call'), (puts, 'put')]:
+            i, j = _pairs(idx, strike)
+            near, far = (i, j) if tipo == 'call' else (j, i)
+            add(f'ratio 1x2 de {tipo}', [(near, 1), (far, -2)])
+
+    if not rows:
+        return [], np.zeros((0, n))
+    return names, np.vstack(rows)
+
+
+def expiry_bounds(Q, strike, is_call, premium):
+    # Max gain and loss at expiry of every candidate at once: the payoff is
+    # piecewise linear with kinks at the strikes, so its extremes are at a
+    # kink or in the right tail
+    knots = np.unique(np.concatenate([[0.], strike]))
+    intrinsic = np.maximum(np.where(is_call, knots[:, None] - strike,
+                                    strike - knots[:, None]), 0)
+    values = intrinsic @ Q.T - Q @ premium
+    slope = Q[:, is_call].sum(axis=1)
+    max_gain = np.where(slope > 0, np.inf, values.max(axis=0))
+    max_loss = np.where(slope < 0, -np.inf, values.min(axis=0))
+    return max_gain, max_loss
+
+
+def _evaluate(Q, terminal_payoff, premium):
+    # terminal_payoff is already discounted to today
+    pnl = terminal_payoff @ Q.T - Q @ premium
+    return pnl.mean(axis=0), (pnl > 0).mean(axis=0)
+
+
+def optimize_strategies(chain, spot, days, selic, max_loss=None,
+                        max_premium=None, delta_band=None,
+                        kinds=STRATEGY_KINDS, npaths=10000, sigma=None,
+                        drift=None, seed=None, top=20, chunk=500,
+                        workers=None):
+    # Ranks multi-leg structures over a chain (rows of compute_chain) by
+    # probability of profit, then expected P&L at expiry discounted to
+    # today. Constraints are checked on the whole candidate matrix before
+    # the simulation, which only runs on the survivors. Terminal prices
+    # follow the distribution implied by the chain's smile, under which
+    # fairly priced structures have zero EV; an annual real-world `drift`
+    # shifts it, and a `sigma` replaces it by a lognormal with that vol.
+    start = datetime.datetime.now()
+    chain = chain[chain['cotacao'].notnull() & (chain['cotacao'] > 0)]
+    chain = chain.reset_index(drop=True)
+    strike = chain['strike'].values.astype(float)
+    is_call = chain['tipo_opcao'].values == 'call'
+    premium = chain['cotacao'].values.astype(float)
+    names, Q = enumerate_strategies(strike, is_call, spot, kinds)
+    ncandidates = len(Q)
+
+    net = Q @ premium
+    delta = Q @ np.nan_to_num(chain['delta'].values.astype(float))
+    max_gain, worst = expiry_bounds(Q, strike, is_call, premium)
+    keep = np.ones(len(Q), bool)
+    if max_loss is not None:
+        keep &= worst >= -max_loss
+    if max_premium is not None:
+        keep &= net <= max_premium
+    if delta_band is not None:
+        keep &= (delta >= delta_band[0]) & (delta <= delta_band[1])
+    names = np.asarray(names, dtype=object)[keep]
+    Q, net, delta = Q[keep], net[keep], delta[keep]
+    max_gain, worst = max_gain[keep], worst[keep]
+
+    if not len(Q):
+        return pd.DataFrame(columns=['estrategia', 'pernas', 'premio', 'delta',
+            'max_gain', 'max_loss', 'ev', 'prob_profit']), Q
+    r = continuous_rate(selic)
+    mu = r if drift is None else drift
+    T = max(int(days), 1) / 252
+    z = np.random.default_rng(seed).standard_normal((npaths + 1) // 2)
+    z = np.concatenate([z, -z])[:npaths]
+    # The smile is read off the out of the money side of each strike
+    vol = chain['Vol'].values.astype(float)
+    otm = np.where(is_call, strike >= spot, strike < spot) & np.isfinite(vol)
+    if sigma is None and len(np.unique(strike[otm])) >= 2:
+        grid, cdf = implied_distribution(strike[otm], vol[otm], spot, selic,
+                                         days)
+        terminal = np.interp(ndtr(z), cdf, grid) * np.exp((mu - r) * T)
+    else:
+        if sigma is None:
+            atm = np.abs(strike - spot) == np.abs(strike - spot).min()
+            sigma = np.nanmedian(vol[atm])
+        sigma = 0.3 if not np.isfinite(sigma) else sigma
+        terminal = spot * np.exp((mu - sigma**2 / 2) * T +
+                                 sigma * np.sqrt(T) * z)
+    payoff = np.exp(-r * T) * np.maximum(
+        np.where(is_call, terminal[:, None] - strike,
+                 strike - terminal[:, None]), 0)
+
+    # numpy releases the GIL in the matmuls, so threads share the payoff
+    # matrix instead of copying it to every process
+    ev, prob = np.zeros(len(Q)), np.zeros(len(Q))
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        chunks = [slice(i, i + chunk) for i in range(0, len(Q), chunk)]
+        for sl, (e, p) in zip(chunks, pool.map(
+                lambda sl: _evaluate(Q[sl], payoff, premium), chunks)):
+            ev[sl], prob[sl] = e, p
+
+    order = np.lexsort((-ev, -prob))[:top]
+    tickers = chain['ticker'].values
+    pernas = [' '.join(f'{row[k]:+g} {tickers[k]}' for k in np.flatnonzero(row))
+              for row in Q[order]]
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    print(f'evaluated {len(Q)} of {ncandidates} strategies in {elapsed:.2f}s')
+    return pd.DataFrame({
+        'estrategia': names[order],
+        'pernas': pernas,
+        'premio': net[order],
+        'delta': delta[order],
+        'max_gain': max_gain[order],
+        'max_loss': worst[order],
+        'ev': ev[order],
+        'prob_profit': 100 * prob[order],
+    }), Q[order]
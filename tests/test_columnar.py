@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from data_helpers import read_columnar, write_columnar
+
+
+def _frame():
+    return pd.DataFrame({
+        'ticker': ['PETRA10', 'VALEA20', 'PETRM10'],
+        'tipo_opcao': pd.Categorical(['call', 'call', 'put']),
+        'strike': [10., 20., 10.],
+        'vencimento': pd.to_datetime(['2026-01-20', '2026-02-17',
+                                      '2026-01-20']),
+    })
+
+
+def test_round_trip(tmp_path):
+    df = _frame()
+    write_columnar(df, str(tmp_path / 'snap'))
+    for mmap in [True, False]:
+        pd.testing.assert_frame_equal(
+            read_columnar(str(tmp_path / 'snap'), mmap=mmap), df,
+            check_dtype=False)
+    res = read_columnar(str(tmp_path / 'snap'))
+    assert not isinstance(res['ticker'].dtype, pd.CategoricalDtype)
+    assert isinstance(res['tipo_opcao'].dtype, pd.CategoricalDtype)
+
+
+def test_where_selects_rows_on_mapped_columns(tmp_path):
+    write_columnar(_frame(), str(tmp_path / 'snap'))
+    seen = {}
+
+    def where(data):
+        seen.update(data)
+        return np.asarray(data['ticker'] == 'PETRM10') | (data['strike'] > 15)
+
+    res = read_columnar(str(tmp_path / 'snap'), where=where)
+    assert isinstance(seen['strike'], np.memmap)
+    assert list(res['ticker']) == ['VALEA20', 'PETRM10']
+    assert list(res['tipo_opcao']) == ['call', 'put']
@@ -0,0 +1,102 @@
+import numpy as np
+
+from finance_helpers import (american_greeks, american_implied_vol, bs_kernel,
+                             bs_price,
+                             implied_vol, implied_vol_vec, payoff_stats)
+
+
+def test_implied_vol_round_trip():
+    strike = np.linspace(70, 130, 13)[:, None, None]
+    sigma = np.array([0.1, 0.3, 0.8])[None, :, None]
+    days = np.array([5, 21, 126, 504])[None, None, :]
+    for tipo in ['call', 'put']:
+        price = bs_price(100., strike, 13.65, sigma, days, tipo)
+        iv = implied_vol_vec(price, 100., strike, 13.65, days, tipo)
+        assert iv.shape == price.shape
+        # Deep in/out of the money prices carry no vol information
+        vega = bs_price(100., strike, 13.65, sigma + 1e-4, days, tipo) - price
+        ok = vega > 1e-6
+        np.testing.assert_allclose(iv[ok], np.broadcast_to(sigma, iv.shape)[ok],
+                                   atol=1e-5)
+
+
+def test_bs_greeks_match_finite_differences():
+    spot, strike, r, T, sigma = 100., np.array([80., 100., 120.]), 0.13, \
+        63 / 252, 0.3
+    h = 1e-4
+    for iscall in [True, False]:
+        price = lambda **kw: bs_kernel(
+            kw.get('spot', spot), strike, kw.get('r', r), kw.get('T', T),
+            kw.get('sigma', sigma), iscall)['price']
+        greeks = bs_kernel(spot, strike, r, T, sigma, iscall,
+                           outputs=('delta', 'gamma', 'vega', 'theta', 'rho'))
+        diff = lambda name, x: (price(**{name: x + h}) -
+                                price(**{name: x - h})) / (2 * h)
+        np.testing.assert_allclose(greeks['delta'], diff('spot', spot),
+                                   atol=1e-6)
+        np.testing.assert_allclose(
+            greeks['gamma'], (price(spot=spot + 1e-2) - 2 * price() +
+                              price(spot=spot - 1e-2)) / 1e-4, atol=1e-5)
+        np.testing.assert_allclose(greeks['vega'], diff('sigma', sigma),
+                                   atol=1e-5)
+        np.testing.assert_allclose(greeks['theta'], -diff('T', T), atol=1e-5)
+        np.testing.assert_allclose(greeks['rho'], diff('r', r), atol=1e-5)
+
+
+def test_implied_vol_outside_bounds():
+    # Below intrinsic, above the spot, zero days and missing quotes
+    iv = implied_vol_vec([1., 150., 5., np.nan], 100., [90., 90., 100., 100.],
+                         13.65, [21, 21, 0, 21], 'call')
+    assert np.isnan(iv).all()
+
+
+def test_implied_vol_scalar():
+    price = bs_price(100., 105., 13.65, 0.25, 42, 'put')
+    assert abs(implied_vol(price, 100., 105., 13.65, 42, 'put') - 0.25) < 1e-6
+
+
+def test_payoff_stats_spread():
+    # Bull call spread 20/25 paid 2: breakeven at 22, gains 3, loses 2
+    stats = payoff_stats([20., 25.], ['call', 'call'], [1, -1], 0, 2.)
+    np.testing.assert_allclose(stats['breakevens'], [22.])
+    assert stats['max_gain'] == 3.
+    assert stats['max_loss'] == -2.
+
+
+def test_payoff_stats_unbounded():
+    # Long straddle: two breakevens and unlimited gain
+    stats = payoff_stats([20., 20.], ['call', 'put'], [1, 1], 0, 3.)
+    np.testing.assert_allclose(stats['breakevens'], [17., 23.])
+    assert stats['max_gain'] == np.inf
+    assert stats['max_loss'] == -3.
+    # Naked short call
+    stats = payoff_stats([20.], ['call'], [-1], 0, -1.)
+    np.testing.assert_allclose(stats['breakevens'], [21.])
+    assert stats['max_gain'] == 1.
+    assert stats['max_loss'] == -np.inf
+    # Covered call: the stock leg caps the loss at spot zero
+    stats = payoff_stats([25.], ['call'], [-1], 1, 19.)
+    np.testing.assert_allclose(stats['breakevens'], [19.])
+    assert stats['max_gain'] == 6.
+    assert stats['max_loss'] == -19.
+
+
+def test_american_tree():
+    strike = np.array([80., 100., 120.])
+    for tipo in ['call', 'put']:
+        european = bs_price(100., strike, 13.65, 0.3, 63, tipo)
+        american = american_greeks(100., strike, 13.65, 0.3, 63, tipo)['price']
+        if tipo == 'call':
+            # No dividends: early exercise of a call is never optimal
+            np.testing.assert_allclose(american, european, atol=0.05)
+        else:
+            assert (american >= european - 1e-3).all()
+            assert american[-1] > european[-1] + 0.1
+
+
+def test_american_implied_vol_round_trip():
+    strike = np.array([90., 100., 110.])
+    price = american_greeks(100., strike, 13.65, 0.35, 42, 'put')['price']
+    iv = american_implied_vol(price, 100., strike, 13.65, 42, 'put')
+    np.testing.assert_allclose(iv, 0.35, atol=1e-4)
+    assert np.isnan(american_implied_vol(5., 100., 110., 13.65, 42, 'put'))
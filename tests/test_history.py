@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from finance_helpers import bs_price
+from history_helpers import (archive_day, archived_months, backtest,
+                             generate_history, last_archived, load_history)
+
+
+DAYS = pd.bdate_range('2026-01-05', '2026-01-09')
+SPOTS = [100., 101., 102., 103., 104.]
+VENCIMENTO = '2026-01-09'
+
+
+def _archive(root, quotes):
+    # One call series; quotes maps a day index to its price
+    for i, day in enumerate(DAYS):
+        chain = pd.DataFrame({'ativo': ['PETR4'], 'ticker': ['PETRA100'],
+                              'tipo_opcao': ['call'], 'strike': [100.],
+                              'vencimento': [pd.Timestamp(VENCIMENTO)],
+                              'cotacao': [quotes.get(i, np.nan)]})
+        spots = pd.DataFrame({'ativo': ['PETR4'], 'cotacao': [SPOTS[i]]})
+        archive_day(day, chain, spots, str(root))
+
+
+def _legs():
+    return [{'ticker': 'PETRA100', 'strike': 100., 'tipo_opcao': 'call',
+             'vencimento': VENCIMENTO, 'posicao': 1, 'Vol': 0.2}]
+
+
+def test_rearchiving_a_day_replaces_it(tmp_path):
+    _archive(tmp_path, {0: 1.5})
+    _archive(tmp_path, {0: 2.5})
+    chains = load_history('chains', 'PETR4', root=str(tmp_path))
+    assert len(chains) == len(DAYS)
+    assert chains['cotacao'].iloc[0] == 2.5
+    assert archived_months('chains', str(tmp_path)) == ['2026-01']
+    assert last_archived(str(tmp_path)) == '2026-01-09'
+    spots = load_history('spots', 'PETR4', start='2026-01-06',
+                         end='2026-01-07', root=str(tmp_path))
+    assert list(spots['cotacao']) == [101., 102.]
+
+
+def test_missing_quotes_have_no_look_ahead(tmp_path):
+    # Only day 2 has a quote, at a 60% vol
+    days = np.busday_count(DAYS.values.astype('datetime64[D]'),
+                           np.datetime64(VENCIMENTO))
+    quote = float(bs_price(SPOTS[2], 100., 13.65, 0.6, days[2]))
+    _archive(tmp_path, {2: quote})
+    res = backtest(_legs(), 0, 'PETR4', selic=13.65, root=str(tmp_path))
+    prices = res['PETRA100'].values
+    # Before the first quote: the leg's own Vol, not the later 60%
+    np.testing.assert_allclose(
+        prices[:2], bs_price(np.array(SPOTS[:2]), 100., 13.65, 0.2, days[:2]))
+    assert prices[2] == quote
+    # After it: the last implied vol seen
+    np.testing.assert_allclose(
+        prices[3], bs_price(SPOTS[3], 100., 13.65, 0.6, days[3]), rtol=1e-4)
+    # Expiry day is worth its intrinsic value
+    assert prices[4] == pytest.approx(SPOTS[4] - 100.)
+    np.testing.assert_allclose(res['pnl'], res['valor'] - res['valor'].iloc[0])
+
+
+def test_backtest_stops_at_expiry(tmp_path):
+    _archive(tmp_path, {})
+    legs = [dict(_legs()[0], vencimento='2026-01-07')]
+    res = backtest(legs, 1, 'PETR4', selic=13.65, root=str(tmp_path))
+    assert list(res.index.strftime('%Y-%m-%d')) == \
+        ['2026-01-05', '2026-01-06', '2026-01-07']
+    assert res['PETRA100'].iloc[-1] == pytest.approx(SPOTS[2] - 100.)
+
+
+def test_backtest_on_generated_history(tmp_path):
+    series = generate_history(str(tmp_path), ('BOVA',), ndays=30, nstrikes=4)
+    legs = series[series['vencimento'] == series['vencimento'].min()] \
+        .assign(posicao=1).iloc[:2]
+    res = backtest(legs, 0, 'BOVA', selic=13.65, root=str(tmp_path))
+    assert res.index[-1] == pd.Timestamp(legs['vencimento'].iloc[0])
+    assert np.isfinite(res[['valor', 'pnl']].values).all()
+    assert res['pnl'].iloc[0] == 0
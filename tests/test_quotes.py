@@ -0,0 +1,114 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+from data_helpers import QuoteService, fetch_quotes
+
+
+PRICES = {f'PETR{i}': 10. + i for i in range(10)}
+
+
+class QuoteHandler(BaseHTTPRequestHandler):
+    # Serves FormConsultaCotacoes.asp like the B3 cotacoes2000 page
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        tickers = query['strListaCodigos'][0].split('|')
+        with self.server.lock:
+            self.server.calls.append(tickers)
+            self.server.ports.add(self.client_address[1])
+        time.sleep(self.server.delay)
+        papeis = ''.join(
+            f'<Papel Codigo="{t}" Nome="{t}" Data="01/01/2020 10:00:00" '
+            f'Abertura="0,00" Minimo="0,00" Maximo="0,00" Medio="0,00" '
+            f'Ultimo="{str(PRICES[t]).replace(".", ",")}" Oscilacao="0,00"/>'
+            for t in tickers if t in PRICES)
+        body = ('<?xml version="1.0" encoding="ISO-8859-1"?>'
+                f'<ComportamentoPapeis>{papeis}</ComportamentoPapeis>'
+                ).encode('latin-1')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), QuoteHandler)
+    server.calls, server.ports, server.delay = [], set(), 0.
+    server.lock = threading.Lock()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}' + \
+        '/cotacoes2000/FormConsultaCotacoes.asp'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_quotes(server):
+    df = fetch_quotes(['PETR1', 'PETR2', 'XXXX11'], base_url=server.url)
+    assert list(df['ticker']) == ['PETR1', 'PETR2']
+    np.testing.assert_allclose(df['cotacao'], [11., 12.])
+    assert server.calls == [['PETR1', 'PETR2', 'XXXX11']]
+
+
+def test_batches(server):
+    service = QuoteService(ttl=60, batch_size=3, base_url=server.url)
+    df = service.get([f'PETR{i}' for i in range(7)])
+    assert sorted(len(c) for c in server.calls) == [1, 3, 3]
+    assert list(df['ticker']) == [f'PETR{i}' for i in range(7)]
+    np.testing.assert_allclose(df['cotacao'], 10. + np.arange(7))
+
+
+def test_pooled_connections_are_reused(server):
+    service = QuoteService(ttl=0, batch_size=1, max_workers=2,
+                           base_url=server.url)
+    for _ in range(5):
+        service.get(['PETR1', 'PETR2'], max_age=0)
+    assert len(server.calls) == 10
+    assert len(server.ports) <= 2
+
+
+def test_ttl_cache(server):
+    service = QuoteService(ttl=60, base_url=server.url)
+    service.get(['PETR1', 'PETR2'])
+    df = service.get(['PETR2', 'PETR1'])
+    assert len(server.calls) == 1
+    assert list(df['ticker']) == ['PETR2', 'PETR1']
+    assert service.stats()['hits'] == 2
+    service.get(['PETR1'], max_age=0)
+    assert server.calls[-1] == ['PETR1']
+
+
+def test_concurrent_requests_coalesce(server):
+    server.delay = 0.2
+    service = QuoteService(ttl=60, base_url=server.url)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        service.get(['PETR1']))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(server.calls) == 1
+    assert all(list(df['cotacao']) == [11.] for df in results)
+
+
+def test_misses_are_cached(server):
+    service = QuoteService(ttl=60, base_url=server.url)
+    df = service.get(['PETR1', 'XXXX11'])
+    assert list(df['ticker']) == ['PETR1']
+    df = service.get(['XXXX11'])
+    assert df.empty
+    assert len(server.calls) == 1
+    assert service.stats()['misses'] == 2
@@ -0,0 +1,25 @@
+import threading
+import time
+
+from data_helpers import Refresher
+
+
+def test_slow_source_runs_in_its_own_thread():
+    release = threading.Event()
+    counts = {'fast': 0}
+
+    def fast():
+        counts['fast'] += 1
+        return counts['fast']
+
+    refresher = Refresher()
+    refresher.add('slow', lambda: release.wait(5), 0.01, own_thread=True)
+    refresher.add('fast', fast, 0.01)
+    refresher.start()
+    try:
+        time.sleep(0.5)
+        assert refresher.get('slow') is None
+        assert refresher.get('fast') >= 3
+    finally:
+        release.set()
+        refresher.stop()
@@ -0,0 +1,37 @@
+import multiprocessing
+
+import pandas as pd
+
+from screener_helpers import update_iv_history
+
+
+def _update(fn, ativo):
+    for day in range(1, 11):
+        update_iv_history(fn, {ativo: 0.2 + day / 100},
+                          today=f'2026-01-{day:02d}')
+
+
+def test_concurrent_iv_history_updates(tmp_path):
+    fn = str(tmp_path / 'iv_history.csv')
+    ativos = [f'ATIV{i}3' for i in range(6)]
+    procs = [multiprocessing.Process(target=_update, args=(fn, a))
+             for a in ativos]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    hist = pd.read_csv(fn)
+    assert sorted(hist['ativo'].unique()) == ativos
+    assert (hist.groupby('ativo').size() == 10).all()
+
+
+def test_iv_rank(tmp_path):
+    fn = str(tmp_path / 'iv_history.csv')
+    update_iv_history(fn, {'PETR4': 0.2}, today='2026-01-01')
+    update_iv_history(fn, {'PETR4': 0.4}, today='2026-01-02')
+    rank = update_iv_history(fn, {'PETR4': 0.25}, today='2026-01-03')
+    assert abs(rank['PETR4'] - 25) < 1e-9
+    # Rerunning a day replaces its row
+    rank = update_iv_history(fn, {'PETR4': 0.3}, today='2026-01-03')
+    assert abs(rank['PETR4'] - 50) < 1e-9
+    assert len(pd.read_csv(fn)) == 3
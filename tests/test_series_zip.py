@@ -0,0 +1,59 @@
+import io
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+from data_helpers import parse_series_zip
+
+
+def _line(tipo, ticker, strike, vencimento, exercicio='AMERICANO'):
+    fields = [''] * 18
+    fields[3], fields[13], fields[15] = tipo, ticker, exercicio
+    fields[16], fields[17] = strike, vencimento
+    return '|'.join(fields)
+
+
+def _fixture(lines, member='SI_D_SEDE.txt'):
+    buf = io.BytesIO()
+    with ZipFile(buf, 'w') as zf:
+        zf.writestr(member, '\r\n'.join(['header'] + lines).encode('latin-1'))
+    buf.seek(0)
+    return buf
+
+
+def test_parse_series_zip(capsys):
+    buf = _fixture([
+        _line('OPCOES COMPRA', 'PETRA100 ', '10,50', '20260120'),
+        _line('OPCOES VENDA', 'PETRM100', '9,75', '20260120', 'EUROPEU'),
+        _line('OPCOES VENDA', 'VALEM200', '60,00', '20260217'),
+        _line('A VISTA', 'PETR4', '0,00', '20260120'),
+        'short|line',
+        _line('OPCOES COMPRA', 'PETRA110', 'abc', '20260120'),
+        _line('OPCOES COMPRA', 'PETRA120', '12,00', '2026XX20'),
+    ])
+    df = parse_series_zip(buf)
+    assert list(df['ticker_opcao']) == ['PETRA100', 'PETRM100', 'VALEM200']
+    assert list(df['tipo_opcao']) == ['call', 'put', 'put']
+    assert list(df['base_ticker']) == ['PETR', 'PETR', 'VALE']
+    assert list(df['tipo_exercicio']) == ['AMERICANO', 'EUROPEU', 'AMERICANO']
+    np.testing.assert_allclose(df['strike'], [10.5, 9.75, 60.])
+    assert list(df['vencimento'].dt.strftime('%Y-%m-%d')) == \
+        ['2026-01-20', '2026-01-20', '2026-02-17']
+    out = capsys.readouterr().out
+    assert "bad expiry '2026XX20'" in out
+    assert '3 malformed' in out
+
+
+def test_missing_member():
+    buf = _fixture([], member='other.txt')
+    with pytest.raises(Exception, match='SI_D_SEDE.txt not found'):
+        parse_series_zip(buf)
+
+
+def test_header_only():
+    df = parse_series_zip(_fixture([]))
+    assert df.empty
+    assert list(df.columns) == ['tipo_opcao', 'ticker_opcao',
+                                'tipo_exercicio', 'strike', 'vencimento',
+                                'base_ticker']
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from finance_helpers import bs_kernel, bs_price, continuous_rate
+from strategy_helpers import optimize_strategies
+
+
+def _skewed_chain(spot=100., selic=13.65, days=42):
+    # Fairly priced chain with a put skew
+    strike = np.arange(80, 121, 2.5)
+    vol = 0.3 + 0.002 * (100 - strike)
+    frames = []
+    for tipo in ['call', 'put']:
+        frames.append(pd.DataFrame({
+            'ticker': [f'{tipo[0].upper()}{k:g}' for k in strike],
+            'strike': strike,
+            'tipo_opcao': tipo,
+            'cotacao': bs_price(spot, strike, selic, vol, days, tipo),
+            'Vol': vol,
+            'delta': bs_kernel(spot, strike, continuous_rate(selic),
+                               days / 252, vol, tipo == 'call',
+                               outputs=('delta',))['delta'],
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_fair_skewed_chain_has_no_edge():
+    df, _ = optimize_strategies(_skewed_chain(), 100., 42, 13.65,
+                                kinds=('vertical', 'straddle', 'condor'),
+                                npaths=100000, seed=0, top=10000)
+    assert len(df) > 100
+    assert df['ev'].abs().max() < 0.05
+
+
+def test_ranked_by_probability_of_profit():
+    df, Q = optimize_strategies(_skewed_chain(), 100., 42, 13.65, max_loss=5,
+                                npaths=20000, seed=0, top=50)
+    assert len(df) == len(Q) == 50
+    assert (np.diff(df['prob_profit'].values) <= 0).all()
+    assert (df['max_loss'] >= -5).all()